@@ -4,6 +4,52 @@
 #define BLUE_BTN 4
 #define LED 8
 
+// Buttons are read by pin-change interrupt, so they must share PORTD
+// (digital pins 0-7). Written for the ATmega328P (Uno/Nano).
+#define BUTTON_COUNT 3
+#define DEBOUNCE_US 5000UL
+
+// ---- TIMING ----
+// The piezo is sampled by the ADC on a Timer1 trigger, so the rate stays
+// exact however busy loop() is. The filters and threshold below are tuned
+// for 100 Hz.
+#define SAMPLE_RATE_HZ 100
+#define SAMPLE_QUEUE 16        // Samples buffered between ISR and loop(), power of 2
+#define TELEMETRY_EVERY 1      // Stream every Nth sample
+#define LED_FLASH_MS 50
+#define HOLDOFF_MS 300         // After a button, before the next tap counts
+#define BUTTON_WAIT_MS 10000   // Give up waiting for a button after a tap
+
+// ---- SERIAL PROTOCOL ----
+// BAUD_RATE must match BAUD_RATE in color_game.py.
+// USE_BINARY_PROTOCOL 1 sends binary frames, 0 sends the plain ASCII lines
+// ("TAP 123456", "RED 123456", "RAW: x | FILTER: y | ENVELOPE: z"). The game
+// accepts both. Events carry micros() from when they happened; the game
+// pings the board to map that clock onto its own. Telemetry streams all the
+// time; if the TX buffer can't take a batch it is dropped, never waited
+// for, so events always go out promptly.
+#define BAUD_RATE 115200
+#define USE_BINARY_PROTOCOL 1
+
+// Frame: SYNC VERSION TYPE LEN PAYLOAD[LEN] CRC16 (little-endian)
+// CRC-16/XMODEM over VERSION..PAYLOAD
+#define FRAME_SYNC 0xA5
+#define PROTOCOL_VERSION 1
+#define FRAME_SAMPLES 0x01  // N x (raw, filter, envelope) int16
+#define FRAME_EVENT 0x02    // 1 byte event code, uint32 micros()
+#define FRAME_PING 0x03     // From the host: uint32 sequence number
+#define FRAME_PONG 0x04     // uint32 sequence number, uint32 micros() on receipt
+#define FRAME_THRESHOLD 0x05  // From the host: uint16 trigger, uint16 re-arm level
+#define SAMPLES_PER_FRAME 8  // 54 byte frame, fits the 64 byte TX buffer
+
+#define EVT_TAP 0
+#define EVT_RED 1
+#define EVT_GREEN 2
+#define EVT_BLUE 3
+const char* const EVENT_NAMES[] = {"TAP", "RED", "GREEN", "BLUE"};
+const uint8_t BUTTON_PINS[BUTTON_COUNT] = {RED_BTN, GREEN_BTN, BLUE_BTN};
+const uint8_t BUTTON_EVENTS[BUTTON_COUNT] = {EVT_RED, EVT_GREEN, EVT_BLUE};
+
 float alpha = 0.90;
 float filtered = 0;
 float envelope = 0;
@@ -13,67 +59,308 @@ float envelope = 0;
 // Lower = Softer hit required
 float threshold = 80; 
 // -------------------------------------------------
+// A new tap needs the envelope back at or below this first. The game
+// auto-calibrates both from the sensor's noise and sends them over serial.
+float releaseLevel = 80;
 
 bool tapDetected = false;
 
+// Game flow: wait for a tap, then for one button, then hold off
+enum Mode { WAIT_TAP, WAIT_BUTTON, HOLDOFF };
+Mode mode = WAIT_TAP;
+unsigned long modeSince = 0;  // millis()
+unsigned long ledOffAt = 0;
+bool ledOn = false;
+
+// Filled by ADC_vect, drained by loop()
+volatile uint16_t sampleValues[SAMPLE_QUEUE];
+volatile unsigned long sampleTimes[SAMPLE_QUEUE];
+volatile uint8_t sampleHead = 0;
+uint8_t sampleTail = 0;
+unsigned long samplesLost = 0;
+
+// Filled by PCINT2_vect: first press of each button since the last read
+volatile uint8_t buttonsPressed = 0;
+volatile unsigned long pressTimes[BUTTON_COUNT];
+volatile unsigned long lastEdge[BUTTON_COUNT];
+volatile uint8_t lastPins = 0xFF;
+
+int16_t sampleBatch[SAMPLES_PER_FRAME * 3];
+uint8_t batchCount = 0;
+uint8_t telemetryCountdown = 0;
+unsigned long telemetryDropped = 0;
+
+// Host -> board frames (same layout): pings and threshold updates
+#define HOST_PAYLOAD_MAX 8
+uint8_t rxFrame[4 + HOST_PAYLOAD_MAX + 2];
+uint8_t rxLen = 0;
+
+// ---- INTERRUPTS ----
+ISR(ADC_vect) {
+  uint8_t i = sampleHead & (SAMPLE_QUEUE - 1);
+  sampleValues[i] = ADC;
+  sampleTimes[i] = micros();
+  sampleHead++;
+  TIFR1 = _BV(OCF1B);  // Re-arm the Timer1 trigger
+}
+
+ISR(PCINT2_vect) {
+  unsigned long now = micros();
+  uint8_t pins = PIND;
+  uint8_t changed = pins ^ lastPins;
+  lastPins = pins;
+  for (uint8_t b = 0; b < BUTTON_COUNT; b++) {
+    uint8_t mask = _BV(BUTTON_PINS[b]);
+    if (!(changed & mask)) continue;
+    // Any edge restarts the bounce window; a press is a falling edge
+    // after the pin has been quiet for DEBOUNCE_US
+    bool quiet = now - lastEdge[b] >= DEBOUNCE_US;
+    lastEdge[b] = now;
+    if (quiet && !(pins & mask) && !(buttonsPressed & _BV(b))) {
+      pressTimes[b] = now;
+      buttonsPressed |= _BV(b);
+    }
+  }
+}
+
+void startSampling() {
+  // Timer1 in CTC mode, /64, compare B fires every 1/SAMPLE_RATE_HZ s
+  TCCR1A = 0;
+  TCCR1B = _BV(WGM12) | _BV(CS11) | _BV(CS10);
+  OCR1A = F_CPU / 64 / SAMPLE_RATE_HZ - 1;
+  OCR1B = OCR1A;
+  TCNT1 = 0;
+  // ADC on the piezo channel, AVcc reference, /128 clock, started by
+  // Timer1 compare match B, interrupt on completion
+  ADMUX = _BV(REFS0) | ((POT - A0) & 0x07);
+  ADCSRB = _BV(ADTS2) | _BV(ADTS0);
+  ADCSRA = _BV(ADEN) | _BV(ADATE) | _BV(ADIE) | _BV(ADPS2) | _BV(ADPS1) | _BV(ADPS0);
+}
+
+void startButtons() {
+  lastPins = PIND;
+  for (uint8_t b = 0; b < BUTTON_COUNT; b++) PCMSK2 |= _BV(BUTTON_PINS[b]);
+  PCIFR = _BV(PCIF2);
+  PCICR |= _BV(PCIE2);
+}
+
+// ---- SERIAL OUT ----
+uint16_t crc16Update(uint16_t crc, uint8_t data) {
+  crc ^= (uint16_t)data << 8;
+  for (uint8_t i = 0; i < 8; i++) {
+    crc = (crc & 0x8000) ? (crc << 1) ^ 0x1021 : (crc << 1);
+  }
+  return crc;
+}
+
+void sendFrame(uint8_t type, const uint8_t* payload, uint8_t len) {
+  uint8_t header[4] = {FRAME_SYNC, PROTOCOL_VERSION, type, len};
+  uint16_t crc = 0;
+  for (uint8_t i = 1; i < 4; i++) crc = crc16Update(crc, header[i]);
+  for (uint8_t i = 0; i < len; i++) crc = crc16Update(crc, payload[i]);
+  Serial.write(header, 4);
+  Serial.write(payload, len);
+  Serial.write((uint8_t)(crc & 0xFF));
+  Serial.write((uint8_t)(crc >> 8));
+}
+
+void sendEvent(uint8_t code, unsigned long t) {
+#if USE_BINARY_PROTOCOL
+  uint8_t payload[5] = {code};
+  memcpy(&payload[1], &t, 4);  // AVR is little-endian
+  sendFrame(FRAME_EVENT, payload, sizeof(payload));
+#else
+  Serial.print(EVENT_NAMES[code]);
+  Serial.print(' ');
+  Serial.println(t);
+#endif
+}
+
+void sendPong(const uint8_t* seq, unsigned long t) {
+#if USE_BINARY_PROTOCOL
+  uint8_t payload[8];
+  memcpy(payload, seq, 4);
+  memcpy(&payload[4], &t, 4);
+  sendFrame(FRAME_PONG, payload, sizeof(payload));
+#else
+  uint32_t n;
+  memcpy(&n, seq, 4);
+  Serial.print("PONG ");
+  Serial.print(n);
+  Serial.print(' ');
+  Serial.println(t);
+#endif
+}
+
+// Reads whatever the host has sent and answers pings. The receive time is
+// taken when the last byte of the frame is read, so call this often.
+void pollHost() {
+  while (Serial.available()) {
+    uint8_t b = Serial.read();
+    unsigned long now = micros();
+    if (rxLen == 0 && b != FRAME_SYNC) continue;
+    rxFrame[rxLen++] = b;
+    if ((rxLen == 2 && b != PROTOCOL_VERSION) || (rxLen == 4 && b > HOST_PAYLOAD_MAX)) {
+      rxLen = 0;  // Not a frame we can take, resync
+      continue;
+    }
+    if (rxLen < 4 || rxLen < 4 + rxFrame[3] + 2) continue;
+
+    uint8_t len = rxFrame[3];
+    uint16_t crc = 0;
+    for (uint8_t i = 1; i < 4 + len; i++) crc = crc16Update(crc, rxFrame[i]);
+    bool valid = rxFrame[4 + len] == (crc & 0xFF) && rxFrame[5 + len] == (crc >> 8);
+    if (valid && rxFrame[2] == FRAME_PING && len == 4) sendPong(&rxFrame[4], now);
+    if (valid && rxFrame[2] == FRAME_THRESHOLD && len == 4) {
+      uint16_t on, off;
+      memcpy(&on, &rxFrame[4], 2);
+      memcpy(&off, &rxFrame[6], 2);
+      if (off <= on) {
+        threshold = on;
+        releaseLevel = off;
+      }
+    }
+    rxLen = 0;
+  }
+}
+
+void sendSample(int raw, float filt, float env) {
+  if (telemetryCountdown) {
+    telemetryCountdown--;
+    return;
+  }
+  telemetryCountdown = TELEMETRY_EVERY - 1;
+#if USE_BINARY_PROTOCOL
+  // Batched so the per-frame overhead is paid once per SAMPLES_PER_FRAME
+  int16_t* slot = &sampleBatch[batchCount * 3];
+  slot[0] = raw;
+  slot[1] = (int16_t)filt;
+  slot[2] = (int16_t)env;
+  if (++batchCount == SAMPLES_PER_FRAME) {
+    batchCount = 0;
+    if (Serial.availableForWrite() < 4 + (int)sizeof(sampleBatch) + 2) {
+      telemetryDropped++;
+      return;
+    }
+    sendFrame(FRAME_SAMPLES, (const uint8_t*)sampleBatch, sizeof(sampleBatch));
+  }
+#else
+  if (Serial.availableForWrite() < 48) {  // Longest line
+    telemetryDropped++;
+    return;
+  }
+  Serial.print("RAW: ");
+  Serial.print(raw);
+  Serial.print(" | FILTER: ");
+  Serial.print((int)filt);
+  Serial.print(" | ENVELOPE: ");
+  Serial.println((int)env);
+#endif
+}
+
+void setMode(Mode next) {
+  mode = next;
+  modeSince = millis();
+}
+
+// ---- TASKS ----
+// Each runs briefly and returns; loop() just cycles through them.
+void processSamples() {
+  while (true) {
+    noInterrupts();
+    uint8_t pending = sampleHead - sampleTail;
+    if (pending > SAMPLE_QUEUE) {  // loop() fell behind; skip to the newest
+      samplesLost += pending - SAMPLE_QUEUE;
+      sampleTail = sampleHead - SAMPLE_QUEUE;
+      pending = SAMPLE_QUEUE;
+    }
+    if (!pending) {
+      interrupts();
+      return;
+    }
+    uint8_t i = sampleTail & (SAMPLE_QUEUE - 1);
+    int raw = sampleValues[i];
+    unsigned long sampledAt = sampleTimes[i];
+    sampleTail++;
+    interrupts();
+
+    // Low Pass Filter (Smooths out jitter)
+    filtered = alpha * filtered + (1 - alpha) * raw;
+    // Envelope Detector (Makes the signal positive and readable)
+    envelope = 0.8 * envelope + 0.2 * abs(filtered);
+    sendSample(raw, filtered, envelope);
+
+    // --- TAP DETECTION ---
+    if (envelope > threshold) {
+      if (!tapDetected && mode == WAIT_TAP) {
+        tapDetected = true;
+        sendEvent(EVT_TAP, sampledAt);
+#if !USE_BINARY_PROTOCOL
+        // DEBUG LOG: See exactly what triggered it
+        Serial.print("[DEBUG] Hit Detected! Force: ");
+        Serial.println(envelope);
+#endif
+        digitalWrite(LED, HIGH);
+        ledOn = true;
+        ledOffAt = millis() + LED_FLASH_MS;
+        setMode(WAIT_BUTTON);
+        noInterrupts();
+        buttonsPressed = 0;  // Only presses after the tap count
+        interrupts();
+      }
+    }
+    else if (envelope <= releaseLevel) {
+      tapDetected = false;
+    }
+  }
+}
+
+void processButtons() {
+  noInterrupts();
+  uint8_t pressed = buttonsPressed;
+  unsigned long times[BUTTON_COUNT];
+  for (uint8_t b = 0; b < BUTTON_COUNT; b++) times[b] = pressTimes[b];
+  buttonsPressed = 0;
+  interrupts();
+  if (!pressed || mode != WAIT_BUTTON) return;
+
+  // Report the earliest press if several landed since the last pass
+  uint8_t first = BUTTON_COUNT;
+  for (uint8_t b = 0; b < BUTTON_COUNT; b++) {
+    if ((pressed & _BV(b)) && (first == BUTTON_COUNT || (long)(times[b] - times[first]) < 0)) first = b;
+  }
+  sendEvent(BUTTON_EVENTS[first], times[first]);
+  setMode(HOLDOFF);
+}
+
+void updateMode() {
+  unsigned long now = millis();
+  if (ledOn && (long)(now - ledOffAt) >= 0) {
+    digitalWrite(LED, LOW);
+    ledOn = false;
+  }
+  if (mode == HOLDOFF && now - modeSince >= HOLDOFF_MS) setMode(WAIT_TAP);
+  if (mode == WAIT_BUTTON && now - modeSince >= BUTTON_WAIT_MS) setMode(WAIT_TAP);
+}
+
 void setup() {
-  Serial.begin(9600);
+  Serial.begin(BAUD_RATE);
   pinMode(RED_BTN, INPUT_PULLUP);
   pinMode(GREEN_BTN, INPUT_PULLUP);
   pinMode(BLUE_BTN, INPUT_PULLUP);
   pinMode(LED, OUTPUT);
   Serial.println("=== SYSTEM READY ===");
+  noInterrupts();
+  startSampling();
+  startButtons();
+  interrupts();
 }
 
+// Never blocks: sampling and buttons are timed by interrupts, and every
+// task only handles what is ready
 void loop() {
-  int raw = analogRead(POT);
-  // Low Pass Filter (Smooths out jitter)
-  filtered = alpha * filtered + (1 - alpha) * raw;
-  // Envelope Detector (Makes the signal positive and readable)
-  envelope = 0.8 * envelope + 0.2 * abs(filtered);
-
-  // --- TAP DETECTION ---
-  if (envelope > threshold) {
-    if (!tapDetected) {
-      tapDetected = true;
-
-      // ==========================================
-      // DEBUG LOG: See exactly what triggered it
-      // ==========================================
-      Serial.print("[DEBUG] Hit Detected! Force: ");
-      Serial.println(envelope);
-      
-      // Send the actual command to Python
-      Serial.println("TAP"); 
-
-      // Flash LED
-      digitalWrite(LED, HIGH);
-      delay(50);
-      digitalWrite(LED, LOW);
-
-      // Wait for Button Logic
-      bool buttonPressed = false;
-      while (!buttonPressed) {
-        if (digitalRead(RED_BTN) == LOW) {
-          Serial.println("RED");
-          buttonPressed = true;
-        }
-        else if (digitalRead(GREEN_BTN) == LOW) {
-          Serial.println("GREEN");
-          buttonPressed = true;
-        }
-        else if (digitalRead(BLUE_BTN) == LOW) {
-          Serial.println("BLUE");
-          buttonPressed = true;
-        }
-        delay(10);
-      }
-      delay(300); // Debounce
-    }
-  }
-  else {
-    tapDetected = false;
-  }
-  
-  delay(10);
-}
\ No newline at end of file
+  pollHost();
+  processButtons();
+  processSamples();
+  updateMode();
+}
@@ -0,0 +1,222 @@
+# ==========================================
+# BENCHMARKS
+# ==========================================
+# Measures the input-to-score pipeline against virtual_arduino.py. Runs
+# headless on SDL's dummy video driver:
+#
+#   python benchmark.py             # everything
+#   python benchmark.py parse render
+#
+# parse     lines / frames / samples per second through Station.parse()
+# queue     pty -> reader -> queue latency, and drops under an event burst
+# clock     event time error over a jittery USB link, host-stamped vs. device clock
+# render    per-frame cost of each screen (draw + present)
+# reaction  measured vs. ground-truth reaction time over full laps
+import os
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+import sys
+import time
+import random
+import struct
+
+import numpy as np
+import pygame
+
+import color_game as cg
+from virtual_arduino import VirtualArduino
+
+def percentiles(values_ms):
+    a = np.asarray(values_ms, dtype=np.float64)
+    if not len(a): return "n/a"
+    p50, p99 = np.percentile(a, [50, 99])
+    return f"p50 {p50:8.3f} ms  p99 {p99:8.3f} ms  max {a.max():8.3f} ms"
+
+def report(name, value):
+    print(f"  {name:<28}{value}")
+
+def feed(station, data, chunk=4096):
+    # Parse data the way the I/O core does: chunked, carrying the tail
+    pending = b""
+    t0 = time.perf_counter_ns()
+    for i in range(0, len(data), chunk):
+        pending += data[i:i + chunk]
+        pending = pending[station.parse(pending, time.perf_counter_ns()):]
+    return (time.perf_counter_ns() - t0) / 1e9
+
+# --- PARSE THROUGHPUT ---
+def bench_parse():
+    print("parse")
+    rng = random.Random(1)
+    n = 100_000
+    rows = [(rng.randrange(1024), rng.randrange(500), rng.randrange(500)) for _ in range(n)]
+
+    station = cg.Station("bench", persist=False)
+    ascii_data = b"".join(b"RAW: %d | FILTER: %d | ENVELOPE: %d\r\n" % r for r in rows)
+    elapsed = feed(station, ascii_data)
+    report("ASCII telemetry", f"{n / elapsed:12,.0f} lines/s")
+
+    per_frame = 10
+    frames = b"".join(
+        cg.encode_frame(cg.FRAME_SAMPLES, b"".join(struct.pack("<3h", *r) for r in rows[i:i + per_frame]))
+        for i in range(0, n, per_frame))
+    elapsed = feed(station, frames)
+    report(f"binary ({per_frame} samples/frame)", f"{n / per_frame / elapsed:12,.0f} frames/s  {n / elapsed:12,.0f} samples/s")
+
+    events = b"".join(cg.encode_frame(cg.FRAME_EVENT, bytes((rng.randrange(4),))) for _ in range(20_000))
+    elapsed = feed(station, events, chunk=256)
+    station.get_events()
+    report("binary events", f"{20_000 / elapsed:12,.0f} events/s")
+
+# --- QUEUE LATENCY / DROPS ---
+def open_reader(device):
+    station = cg.Station(device.port, persist=False)
+    cg.start_serial_reader([station])
+    deadline = time.perf_counter() + 5
+    while not station.link and time.perf_counter() < deadline: time.sleep(0.01)
+    return station
+
+def close_reader():
+    cg.stop_serial_reader()
+
+def bench_queue():
+    print("queue")
+    device = VirtualArduino(sample_rate=1000).start()
+    station = open_reader(device)
+    station.get_events()
+
+    arrival, consume = [], []
+    for _ in range(200):
+        t_write = device.press("GREEN")
+        deadline = time.perf_counter_ns() + 50_000_000
+        events = []
+        while not events and time.perf_counter_ns() < deadline:
+            time.sleep(0.0005)
+            events = station.get_events()
+        t_consume = time.perf_counter_ns()
+        for ev in events:
+            arrival.append((ev.t_ns - t_write) / 1e6)
+            consume.append((t_consume - t_write) / 1e6)
+        time.sleep(0.005)
+    report("write -> reader stamp", percentiles(arrival))
+    report("write -> main loop", percentiles(consume))
+
+    # Burst with nobody consuming: everything past EVENT_QUEUE_SIZE drops
+    dropped_before = station.events_dropped
+    burst = 1000
+    device.write(b"".join(cg.encode_frame(cg.FRAME_EVENT, b"\x00") for _ in range(burst)))
+    time.sleep(0.3)
+    kept = len(station.get_events())
+    report(f"burst of {burst} events", f"kept {kept}  dropped {station.events_dropped - dropped_before}  (queue {cg.EVENT_QUEUE_SIZE})")
+    report("corrupt frames", station.frames_corrupt)
+    report("device bytes dropped", device.bytes_dropped)
+
+    close_reader()
+    device.close()
+
+# --- DEVICE CLOCK SYNC ---
+def bench_clock(presses=200, jitter=0.004, ppm=150.0):
+    print("clock")
+    device = VirtualArduino(sample_rate=200, clock_ppm=ppm, usb_jitter=jitter).start()
+    station = open_reader(device)
+    deadline = time.perf_counter() + 10
+    while not station.clock_sync.synced and time.perf_counter() < deadline: time.sleep(0.05)
+    time.sleep(2.0)  # Enough pongs for the drift fit
+    station.get_events()
+
+    def errors(timestamps):
+        device.timestamps = timestamps
+        out = []
+        for _ in range(presses):
+            t_press = device.press("GREEN")
+            time.sleep(0.01)
+            out += [(ev.t_ns - t_press) / 1e6 for ev in station.get_events()]
+        return out
+
+    report(f"host stamp ({jitter * 1e3:g} ms jitter)", percentiles(errors(False)))
+    report("device clock, mapped", percentiles(errors(True)))
+    sync = station.clock_sync
+    report("drift (true / fitted)", f"{ppm:+.0f} / {sync.drift_ppm:+.0f} ppm  best rtt {sync.min_rtt_ms:.3f} ms")
+    close_reader()
+    device.close()
+
+# --- RENDER COST ---
+def bench_render(frames=300):
+    print("render")
+    # Fill the graph so the telemetry trace is at full length
+    rng = np.random.default_rng(1)
+    station = cg.Station("bench", persist=False)
+    station.sensor_history.extend(rng.integers(0, 500, size=(cg.SENSOR_HISTORY_SIZE, 3)))
+
+    game = cg.Game(rng=random.Random(1))
+    game.history = [{'raw': 250.0 + 30 * i, 'penalty': 1000 * (i == 2), 'status': "CORRECT"} for i in range(5)]
+    game.target_color = "GREEN"
+    scheduler = cg.FrameScheduler(0, False, cg.DISPLAY_REFRESH_HZ, False)
+    for name, state in [("LANDING", cg.STATE_LANDING), ("WAIT_TAP", cg.STATE_WAIT_TAP),
+                        ("COUNTDOWN", cg.STATE_COUNTDOWN), ("GAME_ACTIVE", cg.STATE_GAME_ACTIVE),
+                        ("ROUND_RESULT", cg.STATE_ROUND_RESULT), ("GAME_OVER", cg.STATE_GAME_OVER)]:
+        game.state = state
+        rects = cg.dirty_rects(state)
+        times = []
+        for i in range(frames):
+            scheduler.begin_frame()
+            cg.draw_frame(game, station)
+            scheduler.present(rects if i else None)
+            times.append(scheduler.last_frame_ns / 1e6)
+        report(name, percentiles(times[1:]))
+
+# --- END-TO-END REACTION ERROR ---
+def bench_reaction(laps=10):
+    print("reaction")
+    device = VirtualArduino(sample_rate=200).start()
+    station = open_reader(device)
+    game = cg.Game(rng=random.Random(2))
+    scheduler = cg.FrameScheduler(cg.TARGET_FPS, False, cg.DISPLAY_REFRESH_HZ, cg.LOW_LATENCY)
+    buttons = {"YELLOW": "RED", "GREEN": "GREEN", "BLUE": "BLUE"}
+    rng = random.Random(3)
+
+    def frame(inp=cg.FrameInput()):
+        scheduler.begin_frame()
+        game.update(station.get_events(), inp)
+        cg.draw_frame(game, station)
+        game.on_present(scheduler.present())
+
+    def run_until(cond, timeout=10.0):
+        deadline = time.perf_counter() + timeout
+        while not cond() and time.perf_counter() < deadline: frame()
+        return cond()
+
+    errors, frame_ms = [], []
+    frame(cg.FrameInput(confirm=True))
+    for lap in range(laps):
+        run_until(lambda: game.clock() >= game.safety_cooldown)
+        device.tap()
+        if not run_until(lambda: game.state == cg.STATE_GAME_ACTIVE and game.start_time is not None):
+            print("  lap", lap + 1, "never reached the flag card"); break
+        press_at = game.start_time + int(rng.uniform(0.15, 0.4) * 1e9)
+        run_until(lambda: time.perf_counter_ns() >= press_at)
+        t_press = device.press(buttons[game.target_color])
+        onset = game.start_time
+        run_until(lambda: game.state == cg.STATE_ROUND_RESULT)
+        true_ms = (t_press - onset) / 1e6
+        errors.append(game.history[-1]['raw'] - true_ms)
+        frame_ms.append(scheduler.last_frame_ns / 1e6)
+        if game.round_count == game.max_rounds:
+            frame(cg.FrameInput(confirm=True)); frame(cg.FrameInput(restart=True)); frame(cg.FrameInput(confirm=True))
+        else:
+            frame(cg.FrameInput(confirm=True))
+    report("measured - true", percentiles(errors))
+    report("laps scored", f"{len(errors)} / {laps}")
+
+    close_reader()
+    device.close()
+
+BENCHMARKS = {"parse": bench_parse, "queue": bench_queue, "clock": bench_clock, "render": bench_render,
+              "reaction": bench_reaction}
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    cg.init_display()
+    for name in names:
+        BENCHMARKS[name]()
+    pygame.quit()
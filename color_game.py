@@ -1,19 +1,113 @@
 import pygame
 import serial
+import serial.tools.list_ports
+import numpy as np
 import threading
 import time
 import random
 import re
 import math
-from collections import deque
+import struct
+import binascii
+import functools
+import argparse
+import mmap
+import os
+import json
+import sqlite3
+import queue
+import asyncio
+from collections import deque, namedtuple
+
+import dsp
+from results import ResultsStore
 
 # ==========================================
 # CONFIGURATION
 # ==========================================
-SERIAL_PORT = 'COM8'  # <--- CHECK YOUR PORT
-BAUD_RATE = 9600
+SERIAL_PORT = 'COM8'  # <--- CHECK YOUR PORT ('auto' finds it; several: --port COM8 COM9)
+BAUD_RATE = 115200  # Must match BAUD_RATE in ChromaReflex_Arduino.ino
 WIDTH, HEIGHT = 1280, 720 
 
+# Serial I/O CPU budget: each port is read when it has data and at most
+# once per SERIAL_MIN_WAKE_INTERVAL when busy (bytes are batched in
+# between). A missing or unplugged port is retried after RECONNECT_MIN
+# seconds, doubling up to RECONNECT_MAX.
+SERIAL_MIN_WAKE_INTERVAL = 0.002
+RECONNECT_MIN = 0.5
+RECONNECT_MAX = 8.0
+# A named port is used once it sends the firmware's "=== SYSTEM READY ==="
+# banner or telemetry within PROBE_TIMEOUT seconds. If it doesn't (or the
+# port is 'auto'), every other USB serial port is opened and listened to
+# at once, and the first to answer is taken. Nothing is sent to a port
+# until it has answered. AUTO_DETECT_PORT = False only ever uses the named
+# port, whatever is on it.
+PORT_AUTO = "auto"
+AUTO_DETECT_PORT = True
+PROBE_TIMEOUT = 3.0  # An Uno reboots when its port opens; the banner takes ~2 s
+EVENT_QUEUE_SIZE = 64  # Oldest events are dropped (and counted) past this
+SENSOR_HISTORY_SIZE = 600  # Raw samples kept for the telemetry graph (6 s at 100 Hz)
+# Longer spans come from a min/max pyramid: PYRAMID_LEVELS levels, each
+# PYRAMID_FACTOR times coarser than the last, PYRAMID_CAPACITY buckets each
+# (4..1024 samples per bucket, ~2.9 h at 100 Hz). - and = zoom the graph
+# through TELEMETRY_WINDOWS (seconds).
+PYRAMID_LEVELS = 5
+PYRAMID_FACTOR = 4
+PYRAMID_CAPACITY = 1024
+TELEMETRY_WINDOWS = [1, 6, 30, 60, 300, 900, 3600]
+TELEMETRY_DEFAULT_WINDOW = 6
+TEXT_CACHE_SIZE = 256      # Rendered text surfaces kept by render_text()
+# Font files found by name are remembered in FONT_CACHE_PATH (None = don't):
+# looking them up lists every font on the system, which can take seconds
+FONT_CACHE_PATH = "font_cache.json"
+
+# Host-side DSP (see dsp.py): the sidebar's filter/envelope traces are
+# recomputed from the raw samples by DSP_CHAIN instead of taken from the
+# firmware. With HOST_TAP_DETECTION the chain's detector also decides what
+# counts as a TAP and the firmware's TAP events are ignored.
+HOST_DSP = True
+HOST_TAP_DETECTION = False
+SAMPLE_RATE_HZ = 100  # Must match SAMPLE_RATE_HZ in the sketch
+DSP_CHAIN = dict(alpha=0.90, decay=0.8, on=80, off=60, highpass_hz=None)
+
+# Auto-calibration: the tap threshold and its re-arm level follow the
+# envelope's noise floor (dsp.NoiseFloorCalibrator) and are saved per serial
+# port in CALIBRATION_PATH (None = don't), so a station comes up tuned. Unless
+# HOST_TAP_DETECTION is on, they are sent to the firmware.
+AUTO_CALIBRATE = True
+CALIBRATION_PATH = "calibration.json"
+CALIBRATION_SAVE_INTERVAL = 10.0  # Seconds between saves while it settles
+
+# Device clock sync: the I/O core pings the firmware every CLOCK_SYNC_INTERVAL
+# seconds and fits device micros() to perf_counter over the last
+# CLOCK_SYNC_SAMPLES round trips. Until CLOCK_SYNC_MIN_SAMPLES pongs are in,
+# events keep their host arrival time.
+CLOCK_SYNC_INTERVAL = 0.25
+CLOCK_SYNC_SAMPLES = 64
+CLOCK_SYNC_MIN_SAMPLES = 4
+
+# Frame pacing. With VSYNC the display paces frames at DISPLAY_REFRESH_HZ;
+# otherwise frames are capped at TARGET_FPS (0 = uncapped). LOW_LATENCY
+# delays input polling until just before the next present.
+TARGET_FPS = 120
+VSYNC = False
+DISPLAY_REFRESH_HZ = 60
+LOW_LATENCY = False
+
+# Every session's serial stream and frame inputs are logged here for replay
+RECORD_SESSIONS = True
+SESSION_LOG_DIR = "sessions"
+
+# Laps and sessions are kept in RESULTS_DB_PATH (None = don't) by a
+# background writer; python results.py prints the leaderboard
+RESULTS_DB_PATH = "results.db"
+
+# Pipeline metrics: p50/p99 per stage over each METRICS_WINDOW seconds,
+# appended to METRICS_EXPORT_PATH as JSON lines (None = don't export).
+# F3 toggles the on-screen overlay.
+METRICS_WINDOW = 5.0
+METRICS_EXPORT_PATH = "metrics.jsonl"
+
 # ==========================================
 # F1 THEME PALETTE
 # ==========================================
@@ -32,138 +126,1063 @@ C_GRID = (50, 50, 55)
 GAME_COLORS = {"YELLOW": C_YELLOW, "GREEN": C_GREEN, "BLUE": C_BLUE}
 
 # ==========================================
-# SERIAL CONNECTION
+# SENSOR HISTORY
+# ==========================================
+class SampleRing:
+    # Preallocated (capacity, 3) ring of (raw, filter, envelope) rows.
+    # Written by the I/O core, read by the render loop via snapshot().
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.data = np.zeros((capacity, 3), dtype=np.int16)
+        self.head = 0   # Next row to write
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.count
+
+    def extend(self, rows):
+        rows = np.asarray(rows, dtype=np.int16).reshape(-1, 3)
+        n = len(rows)
+        if n > self.capacity:
+            rows = rows[-self.capacity:]; n = self.capacity
+        with self.lock:
+            first = min(n, self.capacity - self.head)
+            self.data[self.head:self.head + first] = rows[:first]
+            self.data[:n - first] = rows[first:]
+            self.head = (self.head + n) % self.capacity
+            self.count = min(self.count + n, self.capacity)
+
+    def snapshot(self, out=None):
+        # Oldest-to-newest copy, consistent with respect to the writer.
+        # Pass a preallocated (capacity, 3) array as out to avoid allocating.
+        if out is None:
+            out = np.empty_like(self.data)
+        with self.lock:
+            n, head = self.count, self.head
+            tail = n - head if n > head else 0
+            out[:tail] = self.data[self.capacity - tail:]
+            out[tail:n] = self.data[head - (n - tail):head]
+        return out[:n]
+
+    def latest(self):
+        with self.lock:
+            if not self.count: return (0, 0, 0)
+            return tuple(int(v) for v in self.data[self.head - 1])
+
+class MinMaxPyramid(SampleRing):
+    # SampleRing plus decimated copies of the stream for long time spans.
+    # Level k keeps the min and max of each column over buckets of
+    # factor**(k+1) samples, in a ring of `buckets`. A block of samples
+    # costs O(len) over all levels, since each level sees 1/factor of the
+    # rows of the one below; the last few samples of each level wait in
+    # `carry` until they fill a bucket.
+    def __init__(self, capacity, levels=PYRAMID_LEVELS, factor=PYRAMID_FACTOR, buckets=PYRAMID_CAPACITY):
+        super().__init__(capacity)
+        self.factor = factor
+        self.buckets = buckets
+        self.mins = np.zeros((levels, buckets, 3), dtype=np.int16)
+        self.maxs = np.zeros((levels, buckets, 3), dtype=np.int16)
+        self.heads = [0] * levels
+        self.counts = [0] * levels
+        self.carry = [(np.empty((0, 3), np.int16), np.empty((0, 3), np.int16))] * levels
+        self.total = 0  # Samples ever appended
+        # Scratch for window(), so drawing doesn't allocate per frame
+        self.window_lo = np.empty((max(buckets, capacity), 3), dtype=np.int16)
+        self.window_hi = np.empty((max(buckets, capacity), 3), dtype=np.int16)
+
+    def extend(self, rows):
+        rows = np.asarray(rows, dtype=np.int16).reshape(-1, 3)
+        super().extend(rows)
+        with self.lock:
+            self.total += len(rows)
+            lo = hi = rows
+            for k in range(len(self.heads)):
+                lo, hi = self._merge(k, lo, hi)
+                if not len(lo): break
+
+    def _merge(self, k, lo, hi):
+        # Folds child rows into level k; returns the buckets it completed
+        carry_lo, carry_hi = self.carry[k]
+        if len(carry_lo):
+            lo, hi = np.concatenate((carry_lo, lo)), np.concatenate((carry_hi, hi))
+        full = len(lo) - len(lo) % self.factor
+        self.carry[k] = (lo[full:], hi[full:])
+        if not full: return lo[:0], hi[:0]
+        lo = lo[:full].reshape(-1, self.factor, 3).min(axis=1)
+        hi = hi[:full].reshape(-1, self.factor, 3).max(axis=1)
+
+        n = len(lo)
+        kept_lo, kept_hi = lo[-self.buckets:], hi[-self.buckets:]
+        head, m = self.heads[k], len(kept_lo)
+        first = min(m, self.buckets - head)
+        self.mins[k, head:head + first], self.maxs[k, head:head + first] = kept_lo[:first], kept_hi[:first]
+        self.mins[k, :m - first], self.maxs[k, :m - first] = kept_lo[first:], kept_hi[first:]
+        self.heads[k] = (head + m) % self.buckets
+        self.counts[k] = min(self.counts[k] + n, self.buckets)
+        return lo, hi
+
+    def window(self, samples):
+        # The last `samples` samples as (lo, hi, size): per-column min and
+        # max rows, oldest first, each row covering `size` samples. Comes
+        # from the finest level that spans the window, so there are never
+        # more than max(capacity, buckets) rows, however long the window.
+        lo, hi = self.window_lo, self.window_hi
+        if samples <= self.capacity:
+            raw = self.snapshot(lo)[-samples:]
+            return raw, raw, 1
+        size = self.factor
+        for k in range(len(self.heads)):
+            if size * self.buckets >= samples or k == len(self.heads) - 1: break
+            size *= self.factor
+        with self.lock:
+            n = min(self.counts[k], -(-samples // size))
+            head = self.heads[k]
+            wrapped = max(n - head, 0)  # Rows from the end of the ring
+            lo[:wrapped], hi[:wrapped] = self.mins[k, self.buckets - wrapped:], self.maxs[k, self.buckets - wrapped:]
+            lo[wrapped:n], hi[wrapped:n] = self.mins[k, head - (n - wrapped):head], self.maxs[k, head - (n - wrapped):head]
+        return lo[:n], hi[:n], size
+
+# ==========================================
+# METRICS
 # ==========================================
-try:
-    ser = serial.Serial(SERIAL_PORT, BAUD_RATE, timeout=1)
-    time.sleep(2) 
-    print(f"Connected to Arduino on {SERIAL_PORT}")
-except:
-    print(f"ERROR: Could not connect to Arduino.")
-    ser = None
+class Histogram:
+    # Fixed log-scale buckets (4 per power of two, ~19% resolution) in a
+    # preallocated array, so record() is O(1) and allocates nothing.
+    # Values are ns for timings, plain counts for depths.
+    BUCKETS = 160
+
+    def __init__(self, name, unit="ms", scale=1e-6):
+        self.name = name
+        self.unit = unit
+        self.scale = scale
+        self.counts = np.zeros(self.BUCKETS, dtype=np.int64)
+        self.max = 0
+
+    def record(self, value):
+        if value < 4:
+            i = value if value > 0 else 0
+        else:
+            b = value.bit_length()
+            i = min((b - 2) * 4 + ((value >> (b - 3)) & 3), self.BUCKETS - 1)
+        self.counts[i] += 1
+        if value > self.max: self.max = value
+
+    @staticmethod
+    def bucket_floor(i):
+        if i < 4: return i
+        b = i // 4 + 2
+        return (4 + i % 4) << (b - 3)
+
+    def summary(self):
+        total = int(self.counts.sum())
+        if not total: return {"count": 0}
+        cum = np.cumsum(self.counts)
+        p50, p99 = (self.bucket_floor(int(np.searchsorted(cum, total * q))) for q in (0.5, 0.99))
+        return {"count": total, "p50": round(p50 * self.scale, 4), "p99": round(p99 * self.scale, 4),
+                "max": round(self.max * self.scale, 4)}
+
+    def reset(self):
+        self.counts[:] = 0
+        self.max = 0
+
+metrics = {}
+
+def metric(name, unit="ms", scale=1e-6):
+    # Histograms are created once, up front, and then only recorded into
+    if name not in metrics:
+        metrics[name] = Histogram(name, unit, scale)
+    return metrics[name]
+
+M_SERIAL_READ = metric("serial read")
+M_PARSE = metric("parse")
+M_LOCK_WAIT = metric("lock wait")
+M_QUEUE_DEPTH = metric("queue depth", unit="events", scale=1)
+M_EVENT_AGE = metric("event age")
+M_FLIP = metric("display flip")
+M_PING_RTT = metric("ping rtt")
+
+metrics_summary = {}  # Last completed window, shown by the overlay
+metrics_window_start = 0
+
+def roll_metrics_window(now_ns):
+    # Close the current window: summarise, export, reset
+    global metrics_summary, metrics_window_start
+    metrics_summary = {name: h.summary() for name, h in metrics.items()}
+    for h in metrics.values(): h.reset()
+    if METRICS_EXPORT_PATH and metrics_window_start:
+        line = {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "window_s": METRICS_WINDOW,
+                "events_dropped": sum(st.events_dropped for st in stations),
+                "frames_corrupt": sum(st.frames_corrupt for st in stations),
+                "stages": metrics_summary}
+        try:
+            with open(METRICS_EXPORT_PATH, "a") as f:
+                f.write(json.dumps(line) + "\n")
+        except OSError as e:
+            print(f"WARNING: metrics export failed: {e}")
+    metrics_window_start = now_ns
 
 # ==========================================
 # GLOBAL VARIABLES
 # ==========================================
-incoming_data = ""
-lock = threading.Lock()
-sensor_history = deque(maxlen=150) 
-dsp_threshold = 150 
+# kind: "TAP"/"YELLOW"/"GREEN"/"BLUE", t_ns: perf_counter_ns() when it
+# happened (device clock, mapped) or arrived, seq: running count
+SerialEvent = namedtuple("SerialEvent", ["kind", "t_ns", "seq"])
+COLOR_KINDS = ("YELLOW", "GREEN", "BLUE")
+
+stations = []  # Every Station this process serves, set up by main()
 
 # --- TELEMETRY STATE MACHINE ---
 TEL_IDLE = 0
 TEL_IMPACT = 1
 TEL_WAIT_BTN = 2
 
-telemetry_status = TEL_IDLE
-impact_timer = 0
-telemetry_cooldown = 0 
+# ==========================================
+# SERIAL PROTOCOL
+# ==========================================
+# The firmware speaks either the original ASCII lines ("TAP", "RED",
+# "RAW: x | FILTER: y | ENVELOPE: z") or binary frames; both may share
+# one stream. A binary frame is:
+#
+#   SYNC(0xA5) VERSION TYPE LEN PAYLOAD[LEN] CRC16(LE)
+#
+# CRC is CRC-16/XMODEM (binascii.crc_hqx, init 0) over VERSION..PAYLOAD.
+# SYNC is never valid ASCII, so text and frames can be told apart.
+TELEMETRY_PATTERN = re.compile(r"RAW:\s*(-?\d+)\s*\|\s*FILTER:\s*(-?\d+)\s*\|\s*ENVELOPE:\s*(-?\d+)")
+
+FRAME_SYNC = 0xA5
+PROTOCOL_VERSION = 1
+FRAME_HEADER_SIZE = 4
+FRAME_CRC_SIZE = 2
+FRAME_SAMPLES = 0x01  # Payload: N x (raw, filter, envelope) int16 LE
+FRAME_EVENT = 0x02    # Payload: 1 byte event code, uint32 micros() when it happened
+FRAME_PING = 0x03     # Host -> device. Payload: uint32 sequence number
+FRAME_PONG = 0x04     # Payload: uint32 sequence number, uint32 micros() on receipt
+FRAME_THRESHOLD = 0x05  # Host -> device. Payload: uint16 trigger, uint16 re-arm level
+EVENT_CODES = {0: "TAP", 1: "RED", 2: "GREEN", 3: "BLUE"}
+SAMPLE_DTYPE = np.dtype('<i2')
+
+def encode_frame(ftype, payload):
+    body = bytes((PROTOCOL_VERSION, ftype, len(payload))) + bytes(payload)
+    return bytes((FRAME_SYNC,)) + body + struct.pack("<H", binascii.crc_hqx(body, 0))
+
+# ==========================================
+# THRESHOLD CALIBRATION
+# ==========================================
+THRESHOLD_RECORD = struct.Struct("<HH")
+
+def load_calibration(port):
+    # Returns the saved calibrator state for port, or None
+    if not CALIBRATION_PATH: return None
+    try:
+        with open(CALIBRATION_PATH) as f:
+            return json.load(f).get(port)
+    except (OSError, ValueError):
+        return None
+
+def save_calibration(port, state):
+    if not CALIBRATION_PATH: return
+    try:
+        with open(CALIBRATION_PATH) as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        saved = {}
+    saved[port] = dict(state, updated=time.strftime("%Y-%m-%dT%H:%M:%S"))
+    try:
+        # Replaced whole, so a reader never sees half a file
+        with open(CALIBRATION_PATH + ".tmp", "w") as f:
+            json.dump(saved, f, indent=2)
+        os.replace(CALIBRATION_PATH + ".tmp", CALIBRATION_PATH)
+    except OSError as e:
+        print(f"WARNING: could not save calibration: {e}")
+
+# Saves run on their own thread, never on the I/O core (a slow disk would
+# stall every station's reads) or in the frame loop
+calibration_saves = queue.SimpleQueue()  # (port, state), None to stop
+calibration_thread = None
+
+def calibration_writer():
+    while (item := calibration_saves.get()) is not None:
+        save_calibration(*item)
+
+def start_calibration_writer():
+    global calibration_thread
+    calibration_thread = threading.Thread(target=calibration_writer, name="calibration-writer", daemon=True)
+    calibration_thread.start()
+
+def stop_calibration_writer():
+    # Waits for the saves already queued
+    if calibration_thread is None: return
+    calibration_saves.put(None)
+    calibration_thread.join()
+
+# ==========================================
+# CLOCK SYNC
+# ==========================================
+# Events carry the firmware's micros() from the moment they happened, so
+# USB buffering and read wakeups don't end up in reaction times. Each
+# ping/pong gives one (host, device) pair, taking the midpoint of the
+# round trip as the host time the device stamped. Only the fastest round
+# trips are trusted (min-RTT filter); a least-squares line through them
+# gives the offset and the drift between the two clocks.
+PING_RECORD = struct.Struct("<I")
+PONG_RECORD = struct.Struct("<II")
+EVENT_TIME = struct.Struct("<I")
+MAX_CLOCK_DRIFT = 0.01       # Fits steeper than 1% are noise, not a crystal
+CLOCK_SYNC_RTT_SLACK = 100_000  # ns over the fastest round trip still trusted
+CLOCK_SYNC_MIN_SPAN = 2.0     # Seconds of pongs needed before fitting drift
+CLOCK_SYNC_FIT_POINTS = 8     # Stretches of the window the drift fit uses
+
+class ClockSync:
+    PENDING = 16  # Pings awaiting a pong
+
+    def __init__(self, size=CLOCK_SYNC_SAMPLES):
+        # Times are relative to the first pair, so float64 keeps ns precision
+        self.host_ns = np.zeros(size, dtype=np.float64)
+        self.device_us = np.zeros(size, dtype=np.float64)
+        self.rtt_ns = np.zeros(size, dtype=np.float64)
+        self.ping_seq = np.full(self.PENDING, -1, dtype=np.int64)
+        self.ping_ns = np.zeros(self.PENDING, dtype=np.int64)
+        self.next_seq = 0
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.ping_seq[:] = -1
+        self.last_raw = None
+        self.wraps = 0
+        self.host_ref = self.device_ref = 0
+        self.slope = 1000.0  # Host ns per device us
+        self.intercept = 0.0
+        self.synced = False
+
+    def unwrap(self, raw_us):
+        # micros() wraps every 71.6 minutes. Stamps can arrive slightly out
+        # of order, so only a jump of more than half the range is a wrap.
+        if self.last_raw is not None:
+            if raw_us < self.last_raw - 0x80000000:
+                self.wraps += 1
+            elif raw_us > self.last_raw + 0x80000000:
+                return raw_us + ((self.wraps - 1) << 32)  # From before the last wrap
+        self.last_raw = raw_us
+        return raw_us + (self.wraps << 32)
+
+    def on_ping(self, seq, t_ns):
+        slot = seq % self.PENDING
+        self.ping_seq[slot] = seq
+        self.ping_ns[slot] = t_ns
+        self.next_seq = (seq + 1) & 0xFFFFFFFF
+
+    def on_pong(self, seq, raw_us, t_ns):
+        slot = seq % self.PENDING
+        if self.ping_seq[slot] != seq: return  # Unknown, stale or duplicate
+        self.ping_seq[slot] = -1
+        sent_ns = int(self.ping_ns[slot])
+        device_us = self.unwrap(raw_us)
+        M_PING_RTT.record(t_ns - sent_ns)
+        if self.count == 0:
+            self.host_ref, self.device_ref = sent_ns, device_us
+        i = self.count % len(self.rtt_ns)
+        self.host_ns[i] = (sent_ns + t_ns) / 2 - self.host_ref
+        self.device_us[i] = device_us - self.device_ref
+        self.rtt_ns[i] = t_ns - sent_ns
+        self.count += 1
+        self.fit()
+
+    def fit(self):
+        n = min(self.count, len(self.rtt_ns))
+        if n < CLOCK_SYNC_MIN_SAMPLES: return
+        # A slow round trip was slow one way or the other and we can't tell
+        # which, so its midpoint is off by up to half the extra time
+        rtt, x, y = self.rtt_ns[:n], self.device_us[:n], self.host_ns[:n]
+        if np.ptp(x) >= CLOCK_SYNC_MIN_SPAN * 1e6:
+            # Drift: regress through the fastest round trip of each stretch
+            # of the window, so the points are both clean and spread out
+            chunks = np.array_split(np.argsort(x), CLOCK_SYNC_FIT_POINTS)
+            picks = [chunk[np.argmin(rtt[chunk])] for chunk in chunks if len(chunk)]
+            fitted = np.polyfit(x[picks], y[picks], 1)[0]
+            if abs(fitted / 1000.0 - 1) < MAX_CLOCK_DRIFT: self.slope = fitted
+        # Offset: only round trips close to the fastest one
+        fastest = rtt.min()
+        best = rtt <= fastest + max(fastest, CLOCK_SYNC_RTT_SLACK)
+        self.intercept = float(np.mean(y[best] - self.slope * x[best]))
+        self.synced = True
+
+    def to_host(self, device_us):
+        # device_us already unwrapped
+        return int(self.host_ref + self.intercept + self.slope * (device_us - self.device_ref))
+
+    def event_time(self, raw_us, arrival_ns):
+        # Host time of a device-stamped event; arrival time until synced.
+        # An event can't have happened after it arrived.
+        if raw_us is None: return arrival_ns
+        device_us = self.unwrap(raw_us)
+        if not self.synced: return arrival_ns
+        return min(self.to_host(device_us), arrival_ns)
+
+    @property
+    def drift_ppm(self):
+        # How fast the device clock runs, relative to ours
+        return (1000.0 / self.slope - 1) * 1e6
+
+    @property
+    def min_rtt_ms(self):
+        n = min(self.count, len(self.rtt_ns))
+        return float(self.rtt_ns[:n].min()) / 1e6 if n else None
 
-def read_serial():
-    global incoming_data, telemetry_status, impact_timer, telemetry_cooldown
-    pattern = re.compile(r"RAW:\s*(-?\d+)\s*\|\s*FILTER:\s*(-?\d+)\s*\|\s*ENVELOPE:\s*(-?\d+)")
-    while True:
-        if ser and ser.in_waiting:
+# ==========================================
+# STATIONS
+# ==========================================
+# A station is one controller and everything the host keeps for it: its
+# port, event queue, sensor history, filters, calibration and device
+# clock. Bytes from its port (or a replayed log) go in through feed() on
+# the I/O thread; the main loop takes its events with get_events() and
+# draws its telemetry.
+class Station:
+    def __init__(self, port, persist=True):
+        self.port = port
+        self.persist = persist  # Save calibration to CALIBRATION_PATH; off for replays
+        self.ser = None
+        self.link = None  # True/False while the I/O core serves the port; None for replays
+        self.recorder = None  # SessionRecorder while RECORD_SESSIONS is on
+        self.pending = b""
+
+        self.lock = threading.Lock()  # Guards the queue and the telemetry status
+        self.event_queue = deque(maxlen=EVENT_QUEUE_SIZE)
+        self.event_seq = 0
+        self.events_dropped = 0
+        self.frames_corrupt = 0
+
+        self.sensor_history = MinMaxPyramid(SENSOR_HISTORY_SIZE)
+        self.dsp_threshold = 150
+        self.calibration_saved_at = 0.0
+        self.calibration_state = None   # Latest calibrator state the I/O core settled on
+        self.calibration_queued = None  # The last one handed to the writer
+        self.reset_dsp()
+        self.clock_sync = ClockSync()
+
+        # --- TELEMETRY STATE MACHINE ---
+        self.telemetry_status = TEL_IDLE
+        self.impact_timer = 0
+        self.telemetry_cooldown = 0
+
+    # --- PORT ---
+    def open(self, ser=None):
+        # ser: the port already opened by the I/O core's detection
+        self.ser = ser or serial.Serial(self.port, BAUD_RATE, timeout=0)
+        self.pending = b""
+        self.clock_sync.reset()
+        self.link = True
+        if self.calibrator.on is not None: self.send_threshold()
+
+    def close(self):
+        if self.ser:
+            try: self.ser.close()
+            except (serial.SerialException, OSError): pass
+        self.ser = None
+        self.link = False
+
+    def write(self, data):
+        if not self.ser: return
+        try:
+            self.ser.write(data)
+        except (serial.SerialException, OSError):
+            pass  # The I/O core notices a dead port
+
+    def send_ping(self):
+        seq = self.clock_sync.next_seq
+        t_ns = time.perf_counter_ns()
+        self.write(encode_frame(FRAME_PING, PING_RECORD.pack(seq)))
+        self.clock_sync.on_ping(seq, t_ns)
+        if self.recorder: self.recorder.write(t_ns, REC_PING, PING_RECORD.pack(seq))
+
+    def send_threshold(self):
+        if HOST_TAP_DETECTION: return  # The firmware's threshold isn't used
+        on, off = self.calibrator.on, self.calibrator.off
+        self.write(encode_frame(FRAME_THRESHOLD, THRESHOLD_RECORD.pack(round(on), round(off))))
+
+    # --- INPUT ---
+    def feed(self, chunk, arrival_ns):
+        # Bytes as read, stamped with the perf_counter_ns() of the wakeup
+        # that delivered them, not the time the main loop gets around to it
+        t0 = time.perf_counter_ns()
+        M_SERIAL_READ.record(t0 - arrival_ns)
+        if self.recorder: self.recorder.write(arrival_ns, REC_SERIAL, chunk)
+        self.pending += chunk
+        self.pending = self.pending[self.parse(self.pending, arrival_ns):]
+        M_PARSE.record(time.perf_counter_ns() - t0)
+
+    def parse(self, data, arrival_ns):
+        # Parses every complete line and frame in data (bytes); returns the
+        # number of bytes consumed. Whatever is left is an incomplete tail.
+        view = memoryview(data)
+        pos, n = 0, len(data)
+        while pos < n:
+            if data[pos] != FRAME_SYNC:
+                sync = data.find(FRAME_SYNC, pos)
+                nl = data.find(b"\n", pos, sync if sync >= 0 else n)
+                if nl < 0:
+                    if sync < 0: break  # Line still arriving
+                    pos = sync          # Junk before a frame
+                    continue
+                try:
+                    self.handle_serial_line(data[pos:nl].decode('utf-8', errors='ignore').strip(), arrival_ns)
+                except ValueError: pass
+                pos = nl + 1
+                continue
+
+            if n - pos < FRAME_HEADER_SIZE: break
+            version, ftype, length = data[pos + 1], data[pos + 2], data[pos + 3]
+            if version != PROTOCOL_VERSION:
+                pos += 1; continue  # Not a frame start, resync
+            end = pos + FRAME_HEADER_SIZE + length + FRAME_CRC_SIZE
+            if end > n: break
+            body_end = end - FRAME_CRC_SIZE
+            crc, = struct.unpack_from("<H", data, body_end)
+            if binascii.crc_hqx(view[pos + 1:body_end], 0) != crc:
+                self.frames_corrupt += 1
+                pos += 1; continue
+            self.handle_frame(ftype, view[pos + FRAME_HEADER_SIZE:body_end], arrival_ns)
+            pos = end
+        return pos
+
+    def handle_serial_line(self, raw_line, arrival_ns):
+        match = TELEMETRY_PATTERN.search(raw_line)
+        if match:
+            self.handle_samples(np.array([[int(v) for v in match.groups()]]), arrival_ns)
+        elif raw_line.startswith("PONG"):
+            _, seq, device_us = raw_line.split()
+            self.clock_sync.on_pong(int(seq), int(device_us), arrival_ns)
+        elif "SYSTEM READY" in raw_line:
+            self.clock_sync.reset()  # Board reset: micros() starts over
+            if self.calibrator.on is not None: self.send_threshold()
+        else:
+            # "TAP" or, from newer firmware, "TAP <micros>"
+            parts = raw_line.upper().split()
+            if len(parts) == 2 and parts[1].isdigit():
+                self.handle_command(parts[0], arrival_ns, int(parts[1]))
+            else:
+                self.handle_command(raw_line.upper(), arrival_ns)
+
+    def handle_frame(self, ftype, payload, arrival_ns):
+        if ftype == FRAME_SAMPLES:
+            usable = len(payload) - len(payload) % (3 * SAMPLE_DTYPE.itemsize)
+            self.handle_samples(np.frombuffer(payload[:usable], dtype=SAMPLE_DTYPE).reshape(-1, 3), arrival_ns)
+        elif ftype == FRAME_EVENT and len(payload) >= 1:
+            cmd = EVENT_CODES.get(payload[0])
+            device_us = EVENT_TIME.unpack_from(payload, 1)[0] if len(payload) >= 1 + EVENT_TIME.size else None
+            if cmd: self.handle_command(cmd, arrival_ns, device_us)
+        elif ftype == FRAME_PONG and len(payload) >= PONG_RECORD.size:
+            self.clock_sync.on_pong(*PONG_RECORD.unpack_from(payload), arrival_ns)
+
+    def handle_samples(self, samples, arrival_ns):
+        # samples: (N, 3) int array of raw, filter, envelope
+        if not len(samples): return
+        decision_env = samples[:, 2]  # The envelope that decides taps
+        if HOST_DSP:
+            filtered, env, taps = self.dsp_chain.process(samples[:, 0])
+            if HOST_TAP_DETECTION: decision_env = env
+            rows = np.empty((len(samples), 3))
+            rows[:, 0], rows[:, 1], rows[:, 2] = samples[:, 0], filtered, env
+            samples = np.clip(rows, -32768, 32767, out=rows)
+            if HOST_TAP_DETECTION:
+                # The block arrived at once; its last sample is the newest
+                period_ns = 1e9 / SAMPLE_RATE_HZ
+                for i in taps:
+                    self.queue_event("TAP", arrival_ns - int((len(samples) - 1 - i) * period_ns))
+        if AUTO_CALIBRATE and self.calibrator.update(decision_env):
+            self.apply_calibration()
+            self.calibration_state = self.calibrator.state()
+        self.sensor_history.extend(samples)
+        if int(samples[:, 2].max()) > self.dsp_threshold:
+            with self.lock: self.trigger_impact(arrival_ns / 1e9)
+
+    def handle_command(self, cmd, arrival_ns, device_us=None):
+        # device_us: the firmware's micros() for the event, if it sent one
+        if cmd in ["TAP", "RED", "GREEN", "BLUE"]:
+            t_ns = self.clock_sync.event_time(device_us, arrival_ns)
+            if cmd == "TAP" and HOST_DSP and HOST_TAP_DETECTION: return  # dsp_chain decides
+            self.queue_event(cmd, t_ns)
+
+    def queue_event(self, cmd, t_ns):
+        # cmd: "TAP"/"RED"/"GREEN"/"BLUE"; t_ns: when it happened
+        now = t_ns / 1e9
+        t0 = time.perf_counter_ns()
+        with self.lock:
+            M_LOCK_WAIT.record(time.perf_counter_ns() - t0)
+            # --- COLOR MAPPING ---
+            # Convert hardware RED button to software YELLOW
+            kind = "YELLOW" if cmd == "RED" else cmd
+            if len(self.event_queue) == self.event_queue.maxlen:
+                self.events_dropped += 1
+            self.event_queue.append(SerialEvent(kind, t_ns, self.event_seq))
+            self.event_seq += 1
+
+            # --- TELEMETRY LOGIC ---
+            if cmd == "TAP":
+                self.trigger_impact(now)
+
+            elif cmd in ["RED", "GREEN", "BLUE"]:
+                self.telemetry_status = TEL_IDLE
+                self.telemetry_cooldown = now + 1.0
+
+    def trigger_impact(self, now):
+        # Caller holds lock
+        if self.telemetry_status == TEL_IDLE and now > self.telemetry_cooldown:
+            self.telemetry_status = TEL_IMPACT
+            self.impact_timer = now
+
+    def get_events(self):
+        t0 = time.perf_counter_ns()
+        with self.lock:
+            t1 = time.perf_counter_ns()
+            events = list(self.event_queue)
+            self.event_queue.clear()
+        M_LOCK_WAIT.record(t1 - t0)
+        M_QUEUE_DEPTH.record(len(events))
+        for ev in events:
+            M_EVENT_AGE.record(t1 - ev.t_ns)
+        return events
+
+    # --- CALIBRATION ---
+    def reset_dsp(self):
+        # Fresh filter state and calibration
+        self.dsp_chain = dsp.firmware_chain(sample_rate=SAMPLE_RATE_HZ, **DSP_CHAIN)
+        self.calibrator = dsp.NoiseFloorCalibrator()
+
+    def apply_calibration(self):
+        # Puts calibrator's thresholds to use: the graph line, the host
+        # detector and, when it decides taps, the firmware
+        on, off = self.calibrator.on, self.calibrator.off
+        self.dsp_threshold = on
+        self.dsp_chain.detector.on, self.dsp_chain.detector.off = on, off
+        self.send_threshold()
+
+    def load_calibration(self):
+        # Returns True if a saved calibration for this port was loaded
+        saved = load_calibration(self.port)
+        if saved: self.calibrator.load(saved)
+        return bool(saved)
+
+    def save_calibration(self, now=False):
+        # Main thread: queues the latest calibration for the writer, at
+        # most once per CALIBRATION_SAVE_INTERVAL unless now
+        state = self.calibration_state
+        if not self.persist or state is None or state is self.calibration_queued: return
+        if not now and time.monotonic() - self.calibration_saved_at < CALIBRATION_SAVE_INTERVAL: return
+        self.calibration_queued = state
+        self.calibration_saved_at = time.monotonic()
+        calibration_saves.put((self.port, state))
+
+class PortProbe(Station):
+    # Parses a candidate port's output only to tell whether a controller is
+    # on the other end: the ready banner after a reset, or the telemetry a
+    # running board streams (lines or any valid frame)
+    def __init__(self, port, ser):
+        super().__init__(port)
+        self.ser = ser
+        self.answered = False
+
+    def handle_serial_line(self, raw_line, arrival_ns):
+        if "SYSTEM READY" in raw_line or TELEMETRY_PATTERN.search(raw_line):
+            self.answered = True
+
+    def handle_frame(self, ftype, payload, arrival_ns):
+        self.answered = True
+
+# ==========================================
+# SERIAL I/O CORE
+# ==========================================
+# One asyncio loop on one background thread serves every station's port.
+# Each port's task opens it, sleeps until it is readable (on Linux and
+# macOS; elsewhere it polls every SERIAL_MIN_WAKE_INTERVAL), reads what is
+# waiting, parses it and pings on schedule, so a busy port costs the
+# others at most one parse. A port that is missing or drops is retried
+# with exponential backoff, RECONNECT_MIN doubling up to RECONNECT_MAX.
+# With AUTO_DETECT_PORT, a station whose port is 'auto' or has no
+# controller answering on it probes every other free USB port at once and
+# takes the first that answers.
+class SerialCore:
+    PROBE_INTERVAL = 0.02  # Seconds between reads of a port being probed
+
+    def __init__(self, stations):
+        self.stations = list(stations)
+        self.requested = {st: st.port for st in self.stations}  # Ports as configured
+        self.busy = set()  # Ports open by a station or a probe
+        self.loop = asyncio.new_event_loop()
+        self.stopping = asyncio.Event()
+        self.thread = threading.Thread(target=self.run, name="serial-core", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.stopping.set)
+        self.thread.join(timeout=1.0)
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.serve())
+        finally:
+            self.loop.close()
+
+    async def serve(self):
+        tasks = [asyncio.create_task(self.serve_station(st)) for st in self.stations]
+        await self.stopping.wait()
+        for task in tasks: task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def serve_station(self, st):
+        backoff = RECONNECT_MIN
+        st.link = False
+        reported = False
+        while True:
+            if not await self.connect(st):
+                if not reported:
+                    port = self.requested[st]
+                    print("ERROR: No Arduino found, retrying" if port == PORT_AUTO
+                          else f"ERROR: Could not connect to Arduino on {port}, retrying")
+                    reported = True
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, RECONNECT_MAX)
+                continue
+            print(f"Connected to Arduino on {st.port}")
+            backoff = RECONNECT_MIN
+            reported = False
+            try:
+                await self.pump(st)
+            except (serial.SerialException, OSError):
+                print(f"WARNING: lost {st.port}, reconnecting")
+            finally:
+                st.close()
+                self.busy.discard(st.port)
+
+    async def connect(self, st):
+        # Opens the station's configured port or, if no controller answers
+        # on it, the one detect() finds. Returns True once the station is live.
+        port, ser = self.requested[st], None
+        if port != PORT_AUTO and not AUTO_DETECT_PORT:
             try:
-                raw_line = ser.readline().decode('utf-8', errors='ignore').strip()
-                match = pattern.search(raw_line)
-                if match:
-                    env_val = int(match.group(3))
-                    with lock:
-                        sensor_history.append((int(match.group(1)), int(match.group(2)), env_val))
-                        
-                        if env_val > dsp_threshold:
-                            if telemetry_status == TEL_IDLE and time.time() > telemetry_cooldown:
-                                telemetry_status = TEL_IMPACT
-                                impact_timer = time.time()
+                ser = serial.Serial(port, BAUD_RATE, timeout=0)
+            except (serial.SerialException, ValueError, OSError):
+                return False
+        elif port != PORT_AUTO:
+            # Opening isn't enough: the wrong port opens too
+            found = []
+            await self.probe(port, found)
+            if found: ser = found[0][1]
+        if ser is None:
+            # Every station's named port, including this one, is left alone
+            port, ser = await self.detect(exclude=set(self.requested.values()))
+            if ser is None: return False
+        self.busy.add(port)
+        if port != st.port:
+            # Each port keeps its own calibration
+            saved = await self.loop.run_in_executor(None, load_calibration, port) if AUTO_CALIBRATE else None
+            st.port = port
+            st.reset_dsp()
+            st.calibration_state = None
+            if saved:
+                st.calibrator.load(saved)
+                st.apply_calibration()
+        st.open(ser)
+        return True
 
+    async def detect(self, exclude=()):
+        # Probes every free USB serial port concurrently (modems, GPS and
+        # Bluetooth ports have no USB vendor id). Returns (port, open
+        # Serial) for the first controller to answer, or (None, None).
+        found = []
+        infos = await self.loop.run_in_executor(None, serial.tools.list_ports.comports)
+        ports = [info.device for info in infos if info.vid is not None
+                 and info.device not in self.busy and info.device not in exclude]
+        await asyncio.gather(*(self.probe(port, found) for port in ports))
+        return found[0] if found else (None, None)
+
+    async def probe(self, port, found):
+        # Listens to one port for up to PROBE_TIMEOUT, or until another probe
+        # wins; nothing is written to it. The winner appends (port, ser) to
+        # found and leaves it open.
+        self.busy.add(port)
+        ser, won = None, False
+        try:
+            ser = await self.loop.run_in_executor(None, functools.partial(serial.Serial, port, BAUD_RATE, timeout=0))
+            probe = PortProbe(port, ser)
+            deadline = time.monotonic() + PROBE_TIMEOUT
+            while not found and time.monotonic() < deadline:
+                await asyncio.sleep(self.PROBE_INTERVAL)
+                probe.pending += ser.read(ser.in_waiting)
+                probe.pending = probe.pending[probe.parse(probe.pending, time.perf_counter_ns()):]
+                if probe.answered and not found:
+                    found.append((port, ser))
+                    won = True
+        except (serial.SerialException, ValueError, OSError):
+            pass
+        finally:
+            if not won:
+                if ser: ser.close()
+                self.busy.discard(port)
+
+    async def pump(self, st):
+        # Returns only by raising, when the port goes away
+        readable = asyncio.Event()
+        fd = st.ser.fileno() if os.name == "posix" else None
+        if fd is not None: self.loop.add_reader(fd, readable.set)
+        try:
+            next_ping_ns = 0
+            while True:
+                now = time.perf_counter_ns()
+                if now >= next_ping_ns:
+                    st.send_ping()
+                    next_ping_ns = now + int(CLOCK_SYNC_INTERVAL * 1e9)
+                if fd is None:
+                    await asyncio.sleep(SERIAL_MIN_WAKE_INTERVAL)
                 else:
-                    cmd = raw_line.upper()
-                    if cmd in ["TAP", "RED", "GREEN", "BLUE"]:
-                        with lock: 
-                            # --- COLOR MAPPING ---
-                            # Convert hardware RED button to software YELLOW
-                            if cmd == "RED":
-                                incoming_data = "YELLOW"
-                            else:
-                                incoming_data = cmd
-                            
-                            # --- TELEMETRY LOGIC ---
-                            if cmd == "TAP":
-                                if telemetry_status == TEL_IDLE and time.time() > telemetry_cooldown:
-                                    telemetry_status = TEL_IMPACT
-                                    impact_timer = time.time()
-                            
-                            elif cmd in ["RED", "GREEN", "BLUE"]:
-                                telemetry_status = TEL_IDLE
-                                telemetry_cooldown = time.time() + 1.0
-
-            except: pass
-
-if ser:
-    threading.Thread(target=read_serial, daemon=True).start()
+                    try:
+                        await asyncio.wait_for(readable.wait(), (next_ping_ns - now) / 1e9)
+                    except asyncio.TimeoutError:
+                        continue
+                    readable.clear()
+                arrival_ns = time.perf_counter_ns()
+                # Raises if the port reported data but has none: unplugged
+                chunk = st.ser.read(st.ser.in_waiting or 1)
+                if not chunk: continue
+                st.feed(chunk, arrival_ns)
+                # Let the next burst accumulate in the OS buffer
+                await asyncio.sleep(SERIAL_MIN_WAKE_INTERVAL)
+        finally:
+            if fd is not None: self.loop.remove_reader(fd)
+
+serial_core = None
+reader_stop = threading.Event()
+reader_thread = None  # Stands in for the I/O core when replaying a log
+
+def start_serial_reader(serve, replay=None):
+    # Serves the stations' ports, or with replay=records, plays a log into
+    # the one station at its original pace
+    global serial_core, reader_thread
+    reader_stop.clear()
+    if replay is None:
+        serial_core = SerialCore(serve).start()
+        return
+    # Joined by stop_serial_reader(); daemon only so a crash in the main
+    # loop can't leave the interpreter hanging
+    reader_thread = threading.Thread(target=replay_serial, args=(serve[0], replay),
+                                     name="serial-reader", daemon=True)
+    reader_thread.start()
+
+def stop_serial_reader():
+    global serial_core
+    reader_stop.set()
+    if serial_core:
+        serial_core.stop()
+        serial_core = None
+    if reader_thread is not None:
+        reader_thread.join(timeout=1.0)
 
 # ==========================================
 # PYGAME SETUP
 # ==========================================
-pygame.init()
-screen = pygame.display.set_mode((WIDTH, HEIGHT))
-pygame.display.set_caption("ColorTap: DSP-Enabled Reaction Game")
+screen = None
+font_huge = font_large = font_med = font_mono = font_label = None
+
+def init_display(tiles=1):
+    # tiles: station screens, each WIDTH x HEIGHT, laid out by station_grid()
+    global screen, VSYNC, font_huge, font_large, font_med, font_mono, font_label
+    pygame.init()
+    cols, rows = station_grid(tiles)
+    size = (WIDTH * cols, HEIGHT * rows)
+    # A grid keeps its layout and is scaled to whatever the window is
+    flags = pygame.RESIZABLE | (pygame.SCALED if tiles > 1 else 0)
+    try:
+        if not VSYNC: raise pygame.error("vsync disabled")
+        # SDL only honours vsync for renderer-backed (SCALED) windows
+        screen = pygame.display.set_mode(size, pygame.RESIZABLE | pygame.SCALED, vsync=1)
+    except pygame.error:
+        if VSYNC: print("WARNING: vsync unavailable, falling back to TARGET_FPS pacing")
+        VSYNC = False
+        screen = pygame.display.set_mode(size, flags)
+    pygame.display.set_caption("ColorTap: DSP-Enabled Reaction Game")
+
+    # Fonts
+    font_huge, font_large, font_med, font_mono, font_label = load_fonts(
+        [("impact", 90), ("impact", 60), ("bahnschrift", 30), ("consolas", 18), ("bahnschrift", 14)])
 
-# Fonts
-font_huge = pygame.font.SysFont("impact", 90)
-font_large = pygame.font.SysFont("impact", 60)
-font_med = pygame.font.SysFont("bahnschrift", 30)
-font_mono = pygame.font.SysFont("consolas", 18)
-font_label = pygame.font.SysFont("bahnschrift", 14)
+def load_fonts(specs):
+    # specs: [(name, size)]. Same fonts as SysFont(name, size), but the file
+    # each name resolves to (None: not installed, pygame's default font) is
+    # kept in FONT_CACHE_PATH, so later runs skip the system font scan
+    cache = {}
+    if FONT_CACHE_PATH:
+        try:
+            with open(FONT_CACHE_PATH) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            pass
+    stale = False
+    fonts = []
+    for name, size in specs:
+        path = cache.get(name)
+        if name not in cache or (path and not os.path.exists(path)):
+            path = cache[name] = pygame.font.match_font(name)
+            stale = True
+        fonts.append(pygame.font.Font(path, size))
+    if stale and FONT_CACHE_PATH:
+        try:
+            with open(FONT_CACHE_PATH, "w") as f:
+                json.dump(cache, f, indent=2)
+        except OSError as e:
+            print(f"WARNING: could not save font cache: {e}")
+    return fonts
+
+def station_grid(n):
+    # (columns, rows) for n station screens, as square as it gets
+    cols = math.ceil(math.sqrt(n))
+    return cols, math.ceil(n / cols)
+
+def station_tiles(n):
+    # One surface per station, each a WIDTH x HEIGHT view into the window,
+    # so the screens draw straight into place
+    if n == 1: return [screen]
+    cols, _ = station_grid(n)
+    return [screen.subsurface(((i % cols) * WIDTH, (i // cols) * HEIGHT, WIDTH, HEIGHT)) for i in range(n)]
 
 # ==========================================
-# STATES & VARIABLES
+# GAME STATE MACHINE
 # ==========================================
+# Each state is a row in STATE_TABLE with enter/update/render hooks.
+# update() only reads the frame's input and the game clock, and never
+# blocks; delays are timers that fire a transition when they come due.
+# Nothing outside render() touches pygame, so a Game can be driven
+# headless with a fake clock and scripted input.
 STATE_LANDING = 0
 STATE_WAIT_TAP = 1    
-STATE_COUNTDOWN = 1.5
-STATE_GAME_ACTIVE = 2
-STATE_ROUND_RESULT = 3
-STATE_GAME_OVER = 4
-
-current_state = STATE_LANDING
-round_count = 1
-max_rounds = 5
-game_history = [] 
-
-target_color = "YELLOW" # Default
-start_time = 0
-countdown_start = 0
-hold_time = 0
-safety_cooldown = 0 
-round_message = ""
-last_round_success = False 
-badge_text_override = "" 
-session_start_timestamp = 0
-session_end_timestamp = 0
+STATE_COUNTDOWN = 2
+STATE_GAME_ACTIVE = 3
+STATE_ROUND_RESULT = 4
+STATE_GAME_OVER = 5
+
+CLASSIFICATION_HEADERS = ["LAP", "REACT", "PENALTY", "TOTAL"]
+CLASSIFICATION_X = [-200, -80, 50, 180]
+
+StateHooks = namedtuple("StateHooks", ["enter", "update", "render"])
+# Everything the GAME_OVER screen shows, worked out once per session:
+# rows: (lap, raw, penalty, total, color), points: (x, y, label, color)
+SessionSummary = namedtuple("SessionSummary", ["rows", "avg", "elapsed", "points", "standing"])
+# confirm: SPACE pressed or mouse clicked this frame, restart: R pressed
+FrameInput = namedtuple("FrameInput", ["confirm", "restart"], defaults=[False, False])
+
+def seconds_ns(seconds):
+    return int(seconds * 1e9)
+
+class Game:
+    def __init__(self, clock=time.perf_counter_ns, rng=None, max_rounds=5, results=None, station=None):
+        self.clock = clock
+        self.rng = rng or random.Random()
+        self.round_count = 1
+        self.max_rounds = max_rounds
+        self.history = [] 
+        self.results = results  # ResultsStore, or None to keep laps in memory only
+        self.station = station  # Port name the results are filed under
+        self.session = None  # ResultsStore session the laps are filed under
+        self.summary = None  # SessionSummary, rebuilt after history changes
+
+        self.target_color = "YELLOW" # Default
+        self.start_time = None  # Clock of the present that first showed the flag card
+        self.countdown_start = 0
+        self.hold_time = 0
+        self.safety_cooldown = 0 
+        self.notice = None  # (text, color, until) shown under the WAIT_TAP prompt
+        self.round_message = ""
+        self.last_round_success = False 
+        self.badge_text_override = "" 
+        self.session_start_timestamp = 0
+        self.session_end_timestamp = 0
+
+        # Serial events not yet seen by a state, in arrival order
+        self.pending_events = deque()
+        self.input_cutoff_ns = 0
+        self.timers = []  # (due, state)
+
+        self.state = None
+        self.transition(STATE_LANDING)
+
+    def transition(self, state):
+        self.timers.clear()
+        self.state = state
+        enter = STATE_TABLE[state].enter
+        if enter: enter(self)
+
+    def schedule(self, delay, state):
+        self.timers.append((self.clock() + seconds_ns(delay), state))
+
+    def update(self, serial_events=(), inp=FrameInput()):
+        self.pending_events.extend(serial_events)
+        state = self.state
+        STATE_TABLE[state].update(self, inp)
+        if self.state == state:
+            now = self.clock()
+            due = [t for t in self.timers if t[0] <= now]
+            if due: self.transition(min(due)[1])
+        if self.state == state:
+            # Anything left was of no interest to this state
+            self.pending_events.clear()
+
+    def render(self):
+        STATE_TABLE[self.state].render(self)
+
+    def on_present(self, presented_ns):
+        # Stimulus onset is the first present after the flag card was drawn
+        if self.state == STATE_GAME_ACTIVE and self.start_time is None:
+            self.start_time = presented_ns
+
+    def take_event(self, kinds):
+        while self.pending_events:
+            ev = self.pending_events.popleft()
+            if ev.kind in kinds and ev.t_ns >= self.input_cutoff_ns:
+                return ev
+        return None
+
+    def flush_input(self):
+        # Ignore anything that arrived before now
+        self.input_cutoff_ns = self.clock()
+
+    def start_session(self):
+        self.round_count = 1; self.history = []; self.summary = None
+        self.session_start_timestamp = self.clock()
+        if self.results: self.session = self.results.begin_session(self.station)
+
+    def record_lap(self, raw, penalty, status, target=None, press_ns=None):
+        self.history.append({'raw': raw, 'penalty': penalty, 'status': status})
+        self.summary = None
+        if self.results:
+            self.results.record_lap(self.session, len(self.history), raw, penalty, status,
+                                    target, self.start_time if target else None, press_ns)
+
+    def end_session(self):
+        self.session_end_timestamp = self.clock()
+        if self.results:
+            total = sum(h['raw'] + h['penalty'] for h in self.history)
+            self.results.end_session(self.session, len(self.history), total)
+
+    def record_jump_start(self, target=None, press_ns=None):
+        # target: the color picked for this lap, if it got that far
+        self.last_round_success = False
+        self.badge_text_override = "JUMP START"
+        self.round_message = "Penalty: +1000ms"
+        self.record_lap(0, 1000, "FALSE START", target, press_ns)
+        self.transition(STATE_ROUND_RESULT)
 
 # ==========================================
 # HELPER FUNCTIONS
 # ==========================================
-def draw_centered(text, font, color, y_off=0, x_off=0):
+def draw_centered(text, font, color, y_off=0, x_off=0, surface=None):
     game_center_x = 350 + (WIDTH - 350) // 2
-    surf = font.render(text, True, color)
+    surf = render_text(font, text, color)
     rect = surf.get_rect(center=(game_center_x + x_off, HEIGHT // 2 + y_off))
-    screen.blit(surf, rect)
-
-def get_serial_input():
-    global incoming_data
-    with lock:
-        if incoming_data:
-            d = incoming_data
-            incoming_data = "" 
-            return d
-    return None
-
-def flush_serial():
-    global incoming_data
-    with lock: incoming_data = ""
+    (screen if surface is None else surface).blit(surf, rect)
 
 def draw_stylized_f1_car(surface, center_x, center_y, scale=1.0):
     body_col = C_F1_RED
@@ -204,93 +1223,152 @@ def draw_stylized_f1_car(surface, center_x, center_y, scale=1.0):
     pygame.draw.circle(surface, (255, 215, 0), (center_x - s(10), center_y), s(7))
 
 # --- TELEMETRY SIDEBAR ---
-def draw_telemetry():
-    global telemetry_status
-    
+# Scratch buffer reused every frame by draw_telemetry(): one row per
+# sample (or pixel column), x then y for raw/filter/envelope
+telemetry_points = np.empty((max(SENSOR_HISTORY_SIZE, PYRAMID_CAPACITY), 4), dtype=np.float64)
+telemetry_window = TELEMETRY_DEFAULT_WINDOW  # Seconds shown by the graph
+
+def zoom_telemetry(step):
+    # step: +1 shows a longer span, -1 a shorter one
+    global telemetry_window
+    i = TELEMETRY_WINDOWS.index(telemetry_window) if telemetry_window in TELEMETRY_WINDOWS else 0
+    telemetry_window = TELEMETRY_WINDOWS[min(max(i + step, 0), len(TELEMETRY_WINDOWS) - 1)]
+
+def window_label(seconds):
+    if seconds < 60: return f"{seconds} s"
+    if seconds < 3600: return f"{seconds // 60} min"
+    return f"{seconds // 3600} h"
+
+TELEMETRY_LABELS = [("RAW INPUT", (150, 150, 150)), 
+                    ("DSP FILTER", C_TEAL), 
+                    ("ENVELOPE (N)", C_ORANGE)]
+
+def draw_telemetry_static(surface):
+    # Panel chrome that never changes; baked into the static layers
     sidebar_w = 350
-    pygame.draw.rect(screen, C_PANEL, (0, 0, sidebar_w, HEIGHT))
-    pygame.draw.line(screen, C_F1_RED, (sidebar_w, 0), (sidebar_w, HEIGHT), 4)
+    pygame.draw.rect(surface, C_PANEL, (0, 0, sidebar_w, HEIGHT))
+    pygame.draw.line(surface, C_F1_RED, (sidebar_w, 0), (sidebar_w, HEIGHT), 4)
 
-    header = font_med.render("TELEMETRY", True, C_WHITE)
-    screen.blit(header, (20, 20))
-    pygame.draw.rect(screen, C_F1_RED, (20, 55, 60, 4)) 
+    surface.blit(render_text(font_med, "TELEMETRY", C_WHITE), (20, 20))
+    pygame.draw.rect(surface, C_F1_RED, (20, 55, 60, 4)) 
 
-    # LIVE GRAPH
     graph_h = 250
     graph_y = 100
-    pygame.draw.rect(screen, (10, 10, 12), (15, graph_y, sidebar_w-30, graph_h))
-    pygame.draw.rect(screen, C_GRID, (15, graph_y, sidebar_w-30, graph_h), 1)
+    pygame.draw.rect(surface, (10, 10, 12), (15, graph_y, sidebar_w-30, graph_h))
+    pygame.draw.rect(surface, C_GRID, (15, graph_y, sidebar_w-30, graph_h), 1)
     
     for i in range(1, 5):
         y_pos = graph_y + (graph_h / 5) * i
-        pygame.draw.line(screen, (25, 25, 30), (16, y_pos), (sidebar_w-16, y_pos))
+        pygame.draw.line(surface, (25, 25, 30), (16, y_pos), (sidebar_w-16, y_pos))
+
+    y_start = 380
+    for i, (lbl, col) in enumerate(TELEMETRY_LABELS):
+        py = y_start + (i * 50)
+        surface.blit(render_text(font_label, lbl, col), (20, py))
+        pygame.draw.line(surface, C_GRID, (20, py+35), (sidebar_w-20, py+35), 1)
+
+def draw_telemetry(st):
+    # Dynamic part only: station, threshold, live graph, values and status
+    sidebar_w = 350
+
+    if st.link is not None:
+        label = st.port if st.link else "SEARCHING..." if st.port == PORT_AUTO else f"{st.port}  NO LINK"
+        name = render_text(font_label, label, C_GREEN if st.link else C_F1_RED)
+        screen.blit(name, (sidebar_w - 20 - name.get_width(), 28))
 
-    thresh_y = graph_y + graph_h - (dsp_threshold / 500 * graph_h)
+    # LIVE GRAPH
+    graph_h = 250
+    graph_y = 100
+
+    thresh_y = graph_y + graph_h - (min(st.dsp_threshold, 500) / 500 * graph_h)
     pygame.draw.line(screen, C_F1_RED, (15, thresh_y), (sidebar_w-15, thresh_y), 1)
-    screen.blit(font_label.render("TRIG THRESHOLD", True, C_F1_RED), (sidebar_w - 120, thresh_y - 15))
+    auto = " AUTO" if AUTO_CALIBRATE and st.calibrator.on is not None else ""
+    label = render_text(font_label, f"TRIG THRESHOLD {int(st.dsp_threshold)}{auto}", C_F1_RED)
+    screen.blit(label, (sidebar_w - 30 - label.get_width(), thresh_y - 15))
 
-    if len(sensor_history) > 1:
-        x_step = (sidebar_w - 30) / 150
-        pts_raw, pts_filt, pts_env = [], [], []
-        
-        for i, (r, f, e) in enumerate(sensor_history):
-            x = 15 + i * x_step
-            pts_raw.append((x, graph_y + graph_h - (min(r, 500)/500 * graph_h)))
-            pts_filt.append((x, graph_y + graph_h - (min(f, 500)/500 * graph_h)))
-            pts_env.append((x, graph_y + graph_h - (min(e, 500)/500 * graph_h)))
+    # Raw samples draw as lines. Longer windows come back as at most ~1000
+    # min/max rows whatever their length, folded down to one row per pixel
+    # column and drawn as a vertical stroke per column, so drawing costs
+    # the same at 1 s as at 1 h and no spike falls between columns
+    graph_w = sidebar_w - 30
+    window = int(telemetry_window * SAMPLE_RATE_HZ)
+    lo, hi, size = st.sensor_history.window(window)
+    n = len(lo)
+    x_step = graph_w * size / window  # Per row; the trace grows from the left
+    if n > 1 and size == 1:
+        pts = telemetry_points[:n]
+        pts[:, 0] = 15 + np.arange(n) * x_step
+        np.clip(lo, 0, 500, out=pts[:, 1:])
+    elif n > 1:
+        # One zig-zag per trace through each column's max and min, in
+        # alternating order so the joins run min to min and max to max
+        columns = min(n, graph_w)
+        starts = np.arange(columns) * n // columns
+        pts = telemetry_points[:2 * columns]
+        pts[0::2, 0] = pts[1::2, 0] = 15 + starts * x_step
+        top, bottom = np.maximum.reduceat(hi, starts, axis=0), np.minimum.reduceat(lo, starts, axis=0)
+        pts[0::4, 1:], pts[1::4, 1:] = top[0::2], bottom[0::2]
+        pts[2::4, 1:], pts[3::4, 1:] = bottom[1::2], top[1::2]
+        np.clip(pts[:, 1:], 0, 500, out=pts[:, 1:])
+    if n > 1:
+        pts[:, 1:] *= -graph_h / 500
+        pts[:, 1:] += graph_y + graph_h
+        pygame.draw.lines(screen, (60, 60, 60), False, pts[:, (0, 1)].tolist(), 1)
+        pygame.draw.lines(screen, C_TEAL, False, pts[:, (0, 2)].tolist(), 2)
+        pygame.draw.lines(screen, C_ORANGE, False, pts[:, (0, 3)].tolist(), 2)
 
-        pygame.draw.lines(screen, (60, 60, 60), False, pts_raw, 1)  
-        pygame.draw.lines(screen, C_TEAL, False, pts_filt, 2)       
-        pygame.draw.lines(screen, C_ORANGE, False, pts_env, 2)      
+    span = render_text(font_label, window_label(telemetry_window), (150, 150, 150))
+    screen.blit(span, (sidebar_w - 20 - span.get_width(), graph_y + graph_h + 5))
 
-    r, f, e = sensor_history[-1] if sensor_history else (0,0,0)
     y_start = 380
-    labels = [("RAW INPUT", r, (150, 150, 150)), 
-              ("DSP FILTER", f, C_TEAL), 
-              ("ENVELOPE (N)", e, C_ORANGE)]
-    
-    for i, (lbl, val, col) in enumerate(labels):
+    for i, val in enumerate(st.sensor_history.latest()):
         py = y_start + (i * 50)
-        screen.blit(font_label.render(lbl, True, col), (20, py))
         val_surf = font_med.render(f"{val:03}", True, C_WHITE)
         screen.blit(val_surf, (sidebar_w - 80, py - 5))
-        pygame.draw.line(screen, C_GRID, (20, py+35), (sidebar_w-20, py+35), 1)
 
     status_y = 560
     
     # --- LOGIC: STATE VISUALIZATION ---
     # 1. AUTO TRANSITION: Impact (Red) -> Wait Button (Yellow)
-    if telemetry_status == TEL_IMPACT and (time.time() - impact_timer > 0.5):
-        telemetry_status = TEL_WAIT_BTN
+    with st.lock:
+        if st.telemetry_status == TEL_IMPACT and (time.perf_counter() - st.impact_timer > 0.5):
+            st.telemetry_status = TEL_WAIT_BTN
+        telemetry_status = st.telemetry_status
         
     # 2. RENDER STATES
     if telemetry_status == TEL_IMPACT:
         pygame.draw.rect(screen, C_F1_RED, (20, status_y, sidebar_w-40, 60), border_radius=4)
-        msg = font_med.render("IMPACT DETECTED", True, C_WHITE)
+        msg = render_text(font_med, "IMPACT DETECTED", C_WHITE)
         screen.blit(msg, (55, status_y + 15))
         
     elif telemetry_status == TEL_WAIT_BTN:
         pygame.draw.rect(screen, C_ORANGE, (20, status_y, sidebar_w-40, 60), border_radius=4)
-        msg = font_med.render("PRESS A BUTTON", True, (20, 20, 20))
+        msg = render_text(font_med, "PRESS A BUTTON", (20, 20, 20))
         screen.blit(msg, (65, status_y + 15))
         
     else: # IDLE
         pygame.draw.rect(screen, (20, 20, 20), (20, status_y, sidebar_w-40, 60), border_radius=4)
         pygame.draw.rect(screen, C_GRID, (20, status_y, sidebar_w-40, 60), 1, border_radius=4)
-        msg = font_med.render("SENSOR IDLE", True, (80, 80, 80))
+        msg = render_text(font_med, "SENSOR IDLE", (80, 80, 80))
         screen.blit(msg, (100, status_y + 15))
 
-def draw_session_graph(history):
+def draw_session_graph_static(surface):
     c_x = 350 + (WIDTH - 350) // 2
     g_w, g_h = 600, 150
     g_x, g_y = c_x - g_w // 2, HEIGHT - 200 
     
-    pygame.draw.rect(screen, (15, 15, 20), (g_x, g_y, g_w, g_h))
-    pygame.draw.rect(screen, (50, 50, 50), (g_x, g_y, g_w, g_h), 1)
+    pygame.draw.rect(surface, (15, 15, 20), (g_x, g_y, g_w, g_h))
+    pygame.draw.rect(surface, (50, 50, 50), (g_x, g_y, g_w, g_h), 1)
     
-    screen.blit(font_label.render("PACE EVOLUTION", True, (150, 150, 150)), (g_x, g_y - 20))
+    surface.blit(render_text(font_label, "PACE EVOLUTION", (150, 150, 150)), (g_x, g_y - 20))
+
+def session_graph_points(history):
+    # (x, y, label, color) of each lap on the PACE EVOLUTION graph
+    c_x = 350 + (WIDTH - 350) // 2
+    g_w, g_h = 600, 150
+    g_x, g_y = c_x - g_w // 2, HEIGHT - 200 
     
-    if not history: return
+    if not history: return []
 
     max_score = max([h['raw'] + h['penalty'] for h in history]) + 200
     if max_score < 1000: max_score = 1000 
@@ -300,18 +1378,133 @@ def draw_session_graph(history):
         score = entry['raw'] + entry['penalty']
         px = g_x + (g_w / (len(history) + 1)) * (i + 1)
         py = (g_y + g_h) - (score / max_score * g_h) - 10 
-        points.append((px, py))
-        
         col = C_GREEN if entry['status'] == "CORRECT" else C_F1_RED
+        points.append((px, py, str(int(score)), col))
+    return points
+
+def draw_session_graph(points):
+    # Frame comes from the GAME_OVER static layer
+    for px, py, label, col in points:
         pygame.draw.circle(screen, col, (int(px), int(py)), 6)
-        lbl = font_label.render(str(int(score)), True, C_WHITE)
-        screen.blit(lbl, (px - 10, py - 25))
+        screen.blit(render_text(font_label, label, C_WHITE), (px - 10, py - 25))
 
     if len(points) > 1:
-        pygame.draw.lines(screen, C_TEAL, False, points, 2)
+        pygame.draw.lines(screen, C_TEAL, False, [(px, py) for px, py, _, _ in points], 2)
 
 # ==========================================
-# MAIN LOOP
+# RENDER CACHE
+# ==========================================
+# Text that doesn't change frame to frame is rendered once and kept in an
+# LRU; everything static for a state is baked into one full-screen layer.
+# Call invalidate_render_cache() after a resize or a palette change.
+@functools.lru_cache(maxsize=TEXT_CACHE_SIZE)
+def render_text(font, text, color):
+    return font.render(text, True, color)
+
+@functools.lru_cache(maxsize=4)
+def f1_car_sprite(scale):
+    def s(val): return int(val * scale)
+    sprite = pygame.Surface((s(230) + 1, s(130) + 1), pygame.SRCALPHA)
+    draw_stylized_f1_car(sprite, s(100), s(65), scale)
+    return sprite
+
+def blit_f1_car(surface, center_x, center_y, scale=1.0):
+    surface.blit(f1_car_sprite(scale), (center_x - int(100 * scale), center_y - int(65 * scale)))
+
+static_layers = {}
+
+def build_static_layer(state):
+    layer = pygame.Surface((WIDTH, HEIGHT)).convert()
+    layer.fill(C_BG)
+    draw_telemetry_static(layer)
+
+    if state == STATE_LANDING:
+        draw_centered("ColorTap", font_huge, C_WHITE, -160, surface=layer)
+        draw_centered("A DSP-Enabled Visual Reaction Game", font_med, C_F1_RED, -90, surface=layer)
+
+    elif state == STATE_GAME_OVER:
+        draw_centered("SESSION CLASSIFICATION", font_large, C_F1_RED, -300, surface=layer)
+        c_center = 350 + (WIDTH-350)//2
+        pygame.draw.line(layer, (80,80,80), (c_center-250, HEIGHT//2-220), (c_center+250, HEIGHT//2-220), 2)
+        for i, h in enumerate(CLASSIFICATION_HEADERS):
+            layer.blit(render_text(font_label, h, (150,150,150)), (c_center + CLASSIFICATION_X[i], HEIGHT//2 - 240))
+        draw_session_graph_static(layer)
+        draw_centered("[R] RESTART SESSION", font_mono, (150,150,150), 320, surface=layer)
+    return layer
+
+def get_static_layer(state):
+    layer = static_layers.get(state)
+    if layer is None:
+        layer = static_layers[state] = build_static_layer(state)
+    return layer
+
+def invalidate_render_cache():
+    static_layers.clear()
+    render_text.cache_clear()
+    f1_car_sprite.cache_clear()
+
+# ==========================================
+# FRAME SCHEDULER
+# ==========================================
+class FrameScheduler:
+    # Call begin_frame() before polling input and present() instead of
+    # display.flip(). In low-latency mode begin_frame() sleeps until
+    # (next present - expected render time) so the input that is polled
+    # afterwards is as fresh as possible when it reaches the screen.
+    SPIN_NS = 1_000_000  # Busy-wait the last 1 ms; time.sleep overshoots
+
+    def __init__(self, target_fps, vsync, refresh_hz, low_latency):
+        self.vsync = vsync
+        self.low_latency = low_latency
+        rate = refresh_hz if vsync else target_fps
+        self.period_ns = int(1e9 / rate) if rate else 0
+        self.next_present_ns = time.perf_counter_ns()
+        self.render_ns = 2_000_000  # Running estimate of begin -> present
+        self.frame_start_ns = self.next_present_ns
+        self.last_frame_ns = 0
+
+    def begin_frame(self):
+        if self.period_ns and (self.low_latency or not self.vsync):
+            wake = self.next_present_ns
+            if self.low_latency:
+                wake -= self.render_ns + self.render_ns // 4
+            self.sleep_until(wake)
+        self.frame_start_ns = time.perf_counter_ns()
+
+    def sleep_until(self, deadline_ns):
+        remaining = deadline_ns - time.perf_counter_ns()
+        if remaining > self.SPIN_NS:
+            time.sleep((remaining - self.SPIN_NS) / 1e9)
+        if self.low_latency:
+            while time.perf_counter_ns() < deadline_ns: pass
+
+    def present(self, rects=None):
+        t0 = time.perf_counter_ns()
+        if rects is None: pygame.display.flip()
+        else: pygame.display.update(rects)
+        now = time.perf_counter_ns()
+        M_FLIP.record(now - t0)
+        self.last_frame_ns = now - self.frame_start_ns
+        self.render_ns = (self.render_ns * 7 + self.last_frame_ns) // 8
+        if self.vsync:
+            self.next_present_ns = now + self.period_ns  # flip returned at vblank
+        else:
+            self.next_present_ns = max(self.next_present_ns + self.period_ns, now)
+        return now
+
+def dirty_rects(state):
+    # Screens whose main area is static after the first frame only need the
+    # regions that animate presented; None means present the whole window.
+    sidebar = pygame.Rect(0, 0, 350, HEIGHT)
+    if state == STATE_LANDING:
+        center_x = 350 + (WIDTH - 350) // 2
+        return [sidebar, pygame.Rect(center_x - 160, HEIGHT//2 - 70, 360, 310)]
+    if state == STATE_ROUND_RESULT:
+        return [sidebar]
+    return None
+
+# ==========================================
+# STATE HOOKS
 # ==========================================
 def draw_f1_lights(active_lights):
     center_x = 350 + (WIDTH - 350) // 2
@@ -333,164 +1526,486 @@ def draw_flag_card(color_name):
     rect.center = (center_x, HEIGHT//2 + 20)
     pygame.draw.rect(screen, GAME_COLORS[color_name], rect, border_radius=10)
     pygame.draw.rect(screen, C_WHITE, rect, 5, border_radius=10)
-    txt = font_huge.render(color_name, True, (20, 20, 20)) # Dark text on bright color
+    txt = render_text(font_huge, color_name, (20, 20, 20)) # Dark text on bright color
     
     screen.blit(txt, (rect.centerx - txt.get_width()//2, rect.centery - txt.get_height()//2))
 
-running = True
-while running:
-    serial_in = get_serial_input()
-    keys = pygame.key.get_pressed()
-    click = False
-    for event in pygame.event.get():
-        if event.type == pygame.QUIT: running = False
-        if event.type == pygame.MOUSEBUTTONDOWN: click = True
-
-    screen.fill(C_BG)
-    draw_telemetry() # ALWAYS DRAW TELEMETRY
-
-    if current_state == STATE_LANDING:
-        draw_centered("ColorTap", font_huge, C_WHITE, -160)
-        draw_centered("A DSP-Enabled Visual Reaction Game", font_med, C_F1_RED, -90)
-        
-        # --- DRAW F1 CAR WITH RIMS ---
-        hover_y = math.sin(time.time() * 2) * 10
-        center_x = 350 + (WIDTH - 350) // 2
-        draw_stylized_f1_car(screen, center_x, HEIGHT//2 + 50 + hover_y, scale=1.5)
-        # -----------------------------
-
-        if int(time.time() * 2) % 2 == 0:
-            pygame.draw.rect(screen, C_WHITE, (center_x - 150, HEIGHT//2 + 180, 300, 50), border_radius=5)
-            lbl = font_med.render("PRESS SPACE", True, C_BG)
-            screen.blit(lbl, (center_x - lbl.get_width()//2, HEIGHT//2 + 192))
-
-        if keys[pygame.K_SPACE] or click:
-            round_count = 1; game_history = []; flush_serial()
-            current_state = STATE_WAIT_TAP
-            safety_cooldown = time.time() + 1.0
-            session_start_timestamp = time.time()
-
-    elif current_state == STATE_WAIT_TAP:
-        draw_centered(f"ROUND {round_count} / {max_rounds}", font_large, C_WHITE, -100)
-        if time.time() < safety_cooldown:
-            draw_centered("SYSTEM INITIALIZING...", font_med, (100, 100, 100), 50)
-            if serial_in == "TAP":
-                draw_centered("PLEASE WAIT...", font_med, C_F1_RED, 100)
-                pygame.display.flip(); time.sleep(0.3)
+# --- LANDING ---
+def landing_enter(game):
+    game.flush_input()
+
+def landing_update(game, inp):
+    if inp.confirm:
+        game.start_session()
+        game.safety_cooldown = game.clock() + seconds_ns(1.0)
+        game.transition(STATE_WAIT_TAP)
+
+def landing_render(game):
+    # --- DRAW F1 CAR WITH RIMS ---
+    t = game.clock() / 1e9
+    hover_y = math.sin(t * 2) * 10
+    center_x = 350 + (WIDTH - 350) // 2
+    blit_f1_car(screen, center_x, int(HEIGHT//2 + 50 + hover_y), scale=1.5)
+    # -----------------------------
+
+    if int(t * 2) % 2 == 0:
+        pygame.draw.rect(screen, C_WHITE, (center_x - 150, HEIGHT//2 + 180, 300, 50), border_radius=5)
+        lbl = render_text(font_med, "PRESS SPACE", C_BG)
+        screen.blit(lbl, (center_x - lbl.get_width()//2, HEIGHT//2 + 192))
+
+# --- WAIT TAP ---
+def wait_tap_enter(game):
+    game.flush_input()
+    game.notice = None
+
+def wait_tap_update(game, inp):
+    now = game.clock()
+    if game.notice and now >= game.notice[2]:
+        game.notice = None
+    tap = game.take_event(("TAP",))
+    if not tap or game.timers: return
+    if tap.t_ns < game.safety_cooldown:
+        game.notice = ("PLEASE WAIT...", C_F1_RED, now + seconds_ns(0.3))
+    else:
+        game.notice = ("SENSOR TRIGGERED", C_GREEN, now + seconds_ns(0.3))
+        game.schedule(0.3, STATE_COUNTDOWN)
+
+def wait_tap_render(game):
+    draw_centered(f"ROUND {game.round_count} / {game.max_rounds}", font_large, C_WHITE, -100)
+    if game.clock() < game.safety_cooldown:
+        draw_centered("SYSTEM INITIALIZING...", font_med, (100, 100, 100), 50)
+    else:
+        draw_centered("STRIKE SENSOR TO START", font_med, C_F1_RED, 50)
+    if game.notice:
+        draw_centered(game.notice[0], font_med, game.notice[1], 100)
+
+# --- COUNTDOWN ---
+def countdown_enter(game):
+    game.countdown_start = game.clock()
+    game.hold_time = game.rng.uniform(0.2, 1.5)
+    game.schedule(2.5 + game.hold_time, STATE_GAME_ACTIVE)
+
+def countdown_update(game, inp):
+    # Check for Jump Start
+    press = game.take_event(COLOR_KINDS)
+    if press:
+        game.record_jump_start(press_ns=press.t_ns)
+
+def countdown_render(game):
+    elapsed = (game.clock() - game.countdown_start) / 1e9
+    lights = int(elapsed // 0.5)
+    if lights > 5: lights = 5
+    draw_f1_lights(lights)
+
+# --- GAME ACTIVE ---
+def game_active_enter(game):
+    # Pick from NEW colors
+    game.target_color = game.rng.choice(["YELLOW", "GREEN", "BLUE"])
+    game.start_time = None # Stamped by on_present() once the card is shown
+    game.flush_input()
+
+def game_active_update(game, inp):
+    press = game.take_event(COLOR_KINDS)
+    if press and (game.start_time is None or press.t_ns < game.start_time):
+        # Pressed before the card was ever on screen
+        game.record_jump_start(game.target_color, press.t_ns)
+    elif press:
+        reaction = (press.t_ns - game.start_time) / 1e6
+        if press.kind == game.target_color:
+            game.last_round_success = True; game.badge_text_override = ""
+            game.round_message = f"Reaction: {int(reaction)} ms"
+            game.record_lap(reaction, 0, "CORRECT", game.target_color, press.t_ns)
         else:
-            draw_centered("STRIKE SENSOR TO START", font_med, C_F1_RED, 50)
-            if serial_in == "TAP":
-                draw_centered("SENSOR TRIGGERED", font_med, C_GREEN, 100)
-                pygame.display.flip(); time.sleep(0.3)
-                current_state = STATE_COUNTDOWN
-                countdown_start = time.time()
-                hold_time = random.uniform(0.2, 1.5)
-
-    elif current_state == STATE_COUNTDOWN:
-        elapsed = time.time() - countdown_start
-        lights = int(elapsed // 0.5)
-        if lights > 5: lights = 5
-        draw_f1_lights(lights)
-        # Check for Jump Start
-        if serial_in in ["YELLOW", "GREEN", "BLUE"]:
-            last_round_success = False
-            badge_text_override = "JUMP START"
-            round_message = "Penalty: +1000ms"
-            game_history.append({'raw': 0, 'penalty': 1000, 'status': "FALSE START"})
-            current_state = STATE_ROUND_RESULT
-            flush_serial()
-        elif elapsed > 2.5 + hold_time:
-            # Pick from NEW colors
-            target_color = random.choice(["YELLOW", "GREEN", "BLUE"])
-            current_state = STATE_GAME_ACTIVE
-            start_time = time.time()
-            flush_serial()
-
-    elif current_state == STATE_GAME_ACTIVE:
-        draw_flag_card(target_color)
-        if serial_in in ["YELLOW", "GREEN", "BLUE"]:
-            reaction = (time.time() - start_time) * 1000
-            if serial_in == target_color:
-                last_round_success = True; badge_text_override = ""
-                round_message = f"Reaction: {int(reaction)} ms"
-                game_history.append({'raw': reaction, 'penalty': 0, 'status': "CORRECT"})
-            else:
-                last_round_success = False; badge_text_override = "WRONG COLOR"
-                round_message = f"Total: {int(reaction+1000)} ms"
-                game_history.append({'raw': reaction, 'penalty': 1000, 'status': "WRONG COLOR"})
-            current_state = STATE_ROUND_RESULT
+            game.last_round_success = False; game.badge_text_override = "WRONG COLOR"
+            game.round_message = f"Total: {int(reaction+1000)} ms"
+            game.record_lap(reaction, 1000, "WRONG COLOR", game.target_color, press.t_ns)
+        game.transition(STATE_ROUND_RESULT)
 
-    elif current_state == STATE_ROUND_RESULT:
-        c_center = 350 + (WIDTH-350)//2
-        bg_col = C_GREEN if last_round_success else C_F1_RED
-        txt = badge_text_override if badge_text_override else ("SECTOR CLEAR" if last_round_success else "INCIDENT")
-        pygame.draw.rect(screen, bg_col, (c_center-250, HEIGHT//2-80, 500, 100), border_radius=10)
-        lbl = font_large.render(txt, True, C_WHITE)
-        screen.blit(lbl, (c_center - lbl.get_width()//2, HEIGHT//2 - 60))
-        draw_centered(round_message, font_med, C_WHITE, 60)
-        draw_centered("PRESS SPACE FOR NEXT LAP", font_mono, (150, 150, 150), 120)
-
-        if keys[pygame.K_SPACE] or click:
-            if round_count < max_rounds:
-                round_count += 1; current_state = STATE_WAIT_TAP
-                flush_serial(); safety_cooldown = time.time() + 0.5
-            else:
-                current_state = STATE_GAME_OVER
-                session_end_timestamp = time.time()
-            time.sleep(0.2)
+def game_active_render(game):
+    draw_flag_card(game.target_color)
 
-    elif current_state == STATE_GAME_OVER:
-        draw_centered("SESSION CLASSIFICATION", font_large, C_F1_RED, -300)
-        
-        c_center = 350 + (WIDTH-350)//2
-        headers = ["LAP", "REACT", "PENALTY", "TOTAL"]
-        x_positions = [-200, -80, 50, 180]
-        
-        pygame.draw.line(screen, (80,80,80), (c_center-250, HEIGHT//2-220), (c_center+250, HEIGHT//2-220), 2)
-        
-        for i, h in enumerate(headers):
-            surf = font_label.render(h, True, (150,150,150))
-            screen.blit(surf, (c_center + x_positions[i], HEIGHT//2 - 240))
+# --- ROUND RESULT ---
+def round_result_update(game, inp):
+    if inp.confirm:
+        if game.round_count < game.max_rounds:
+            game.round_count += 1
+            game.safety_cooldown = game.clock() + seconds_ns(0.5)
+            game.transition(STATE_WAIT_TAP)
+        else:
+            game.end_session()
+            game.transition(STATE_GAME_OVER)
 
-        total_score = 0
-        start_y = -200
-        
-        for i, entry in enumerate(game_history):
-            raw = int(entry['raw'])
-            pen = int(entry['penalty'])
-            score = raw + pen
-            total_score += score
-            
-            col = C_GREEN if entry['status']=="CORRECT" else C_F1_RED
-            y_pos = HEIGHT//2 + start_y + (i * 40) 
-            
-            screen.blit(font_mono.render(f"{i+1}", True, C_WHITE), (c_center + x_positions[0] + 10, y_pos))
-            screen.blit(font_mono.render(f"{raw}", True, C_WHITE), (c_center + x_positions[1], y_pos))
-            screen.blit(font_mono.render(f"+{pen}", True, (255,100,100) if pen > 0 else (100,100,100)), (c_center + x_positions[2] + 10, y_pos))
-            screen.blit(font_mono.render(f"{score}", True, col), (c_center + x_positions[3], y_pos))
-            pygame.draw.line(screen, (40,40,40), (c_center-250, y_pos+30), (c_center+250, y_pos+30), 1)
-
-        avg = int(total_score / len(game_history)) if game_history else 0
-        pygame.draw.rect(screen, C_WHITE, (c_center-200, HEIGHT//2 + 30, 200, 50), border_radius=5)
-        lbl = font_med.render(f"AVG: {avg} ms", True, C_BG)
-        screen.blit(lbl, (c_center - 200 + 100 - lbl.get_width()//2, HEIGHT//2 + 42))
-
-        elapsed = session_end_timestamp - session_start_timestamp
-        mins = int(elapsed // 60)
-        secs = int(elapsed % 60)
-        pygame.draw.rect(screen, C_WHITE, (c_center+10, HEIGHT//2 + 30, 200, 50), border_radius=5)
-        lbl_time = font_med.render(f"TIME: {mins}:{secs:02}", True, C_BG)
-        screen.blit(lbl_time, (c_center + 10 + 100 - lbl_time.get_width()//2, HEIGHT//2 + 42))
+def round_result_render(game):
+    c_center = 350 + (WIDTH-350)//2
+    bg_col = C_GREEN if game.last_round_success else C_F1_RED
+    txt = game.badge_text_override if game.badge_text_override else ("SECTOR CLEAR" if game.last_round_success else "INCIDENT")
+    pygame.draw.rect(screen, bg_col, (c_center-250, HEIGHT//2-80, 500, 100), border_radius=10)
+    lbl = render_text(font_large, txt, C_WHITE)
+    screen.blit(lbl, (c_center - lbl.get_width()//2, HEIGHT//2 - 60))
+    draw_centered(game.round_message, font_med, C_WHITE, 60)
+    draw_centered("PRESS SPACE FOR NEXT LAP", font_mono, (150, 150, 150), 120)
+
+# --- GAME OVER ---
+def game_over_update(game, inp):
+    if inp.restart:
+        game.transition(STATE_LANDING)
+
+def summarize_session(game):
+    # Totals, graph layout and all-time standing for the GAME_OVER screen
+    rows = []
+    total_score = 0
+    for i, entry in enumerate(game.history):
+        raw = int(entry['raw'])
+        pen = int(entry['penalty'])
+        score = raw + pen
+        total_score += score
+        col = C_GREEN if entry['status']=="CORRECT" else C_F1_RED
+        rows.append((i + 1, raw, pen, score, col))
+
+    avg = int(total_score / len(game.history)) if game.history else 0
+    elapsed = (game.session_end_timestamp - game.session_start_timestamp) / 1e9
+    standing = None
+    if game.results and game.history:
+        # The writer may not have committed this session yet, so it is
+        # left out of the count and ranked by its average
+        rank, of = game.results.rank(total_score / len(game.history), exclude=game.session)
+        standing = f"ALL-TIME RANK {rank} / {of}"
+    return SessionSummary(rows, avg, f"{int(elapsed // 60)}:{int(elapsed % 60):02}",
+                          session_graph_points(game.history), standing)
+
+def game_over_render(game):
+    # Title, headers and graph frame come from the static layer
+    if game.summary is None: game.summary = summarize_session(game)
+    summary = game.summary
+    c_center = 350 + (WIDTH-350)//2
+    x_positions = CLASSIFICATION_X
+
+    start_y = -200
+    
+    for i, (lap, raw, pen, score, col) in enumerate(summary.rows):
+        y_pos = HEIGHT//2 + start_y + (i * 40) 
         
-        draw_session_graph(game_history)
+        screen.blit(render_text(font_mono, f"{lap}", C_WHITE), (c_center + x_positions[0] + 10, y_pos))
+        screen.blit(render_text(font_mono, f"{raw}", C_WHITE), (c_center + x_positions[1], y_pos))
+        screen.blit(render_text(font_mono, f"+{pen}", (255,100,100) if pen > 0 else (100,100,100)), (c_center + x_positions[2] + 10, y_pos))
+        screen.blit(render_text(font_mono, f"{score}", col), (c_center + x_positions[3], y_pos))
+        pygame.draw.line(screen, (40,40,40), (c_center-250, y_pos+30), (c_center+250, y_pos+30), 1)
+
+    pygame.draw.rect(screen, C_WHITE, (c_center-200, HEIGHT//2 + 30, 200, 50), border_radius=5)
+    lbl = render_text(font_med, f"AVG: {summary.avg} ms", C_BG)
+    screen.blit(lbl, (c_center - 200 + 100 - lbl.get_width()//2, HEIGHT//2 + 42))
+
+    pygame.draw.rect(screen, C_WHITE, (c_center+10, HEIGHT//2 + 30, 200, 50), border_radius=5)
+    lbl_time = render_text(font_med, f"TIME: {summary.elapsed}", C_BG)
+    screen.blit(lbl_time, (c_center + 10 + 100 - lbl_time.get_width()//2, HEIGHT//2 + 42))
+    if summary.standing:
+        draw_centered(summary.standing, font_mono, (150, 150, 150), 110)
+    
+    draw_session_graph(summary.points)
+
+STATE_TABLE = {
+    STATE_LANDING:      StateHooks(landing_enter, landing_update, landing_render),
+    STATE_WAIT_TAP:     StateHooks(wait_tap_enter, wait_tap_update, wait_tap_render),
+    STATE_COUNTDOWN:    StateHooks(countdown_enter, countdown_update, countdown_render),
+    STATE_GAME_ACTIVE:  StateHooks(game_active_enter, game_active_update, game_active_render),
+    STATE_ROUND_RESULT: StateHooks(None, round_result_update, round_result_render),
+    STATE_GAME_OVER:    StateHooks(None, game_over_update, game_over_render),
+}
+
+STATE_NAMES = {STATE_LANDING: "LANDING", STATE_WAIT_TAP: "WAIT_TAP", STATE_COUNTDOWN: "COUNTDOWN",
+               STATE_GAME_ACTIVE: "GAME_ACTIVE", STATE_ROUND_RESULT: "ROUND_RESULT", STATE_GAME_OVER: "GAME_OVER"}
+M_UPDATE = {state: metric(f"update {name}") for state, name in STATE_NAMES.items()}
+M_RENDER = {state: metric(f"render {name}") for state, name in STATE_NAMES.items()}
+
+def update_game(game, serial_events, inp):
+    state = game.state
+    t0 = time.perf_counter_ns()
+    game.update(serial_events, inp)
+    M_UPDATE[state].record(time.perf_counter_ns() - t0)
+
+def draw_frame(game, st):
+    t0 = time.perf_counter_ns()
+    screen.blit(get_static_layer(game.state), (0, 0))
+    draw_telemetry(st) # ALWAYS DRAW TELEMETRY
+    game.render()
+    M_RENDER[game.state].record(time.perf_counter_ns() - t0)
+
+def draw_metrics_overlay():
+    # Sits beside the telemetry sidebar; values are from the last window
+    x, y = 360, 10
+    rows = [(name, m) for name, m in metrics_summary.items() if m.get("count")]
+    synced = [st for st in stations if st.clock_sync.synced]
+    screen.blit(metrics_panel(len(rows) + len(synced)), (x, y))
+    screen.blit(render_text(font_label, f"STAGE p50 / p99  ({METRICS_WINDOW:g} s window)", C_TEAL), (x + 10, y + 6))
+    for i, (name, m) in enumerate(rows):
+        line = f"{name:<20}{m['p50']:7.3f} /{m['p99']:7.3f} {metrics[name].unit}"
+        screen.blit(render_text(font_mono, line, C_WHITE), (x + 10, y + 28 + 20 * i))
+    for i, st in enumerate(synced):
+        sync = st.clock_sync
+        line = f"device clock drift {sync.drift_ppm:+.0f} ppm, best rtt {sync.min_rtt_ms:.2f} ms"
+        if len(stations) > 1: line = f"{st.port}: {line}"
+        screen.blit(render_text(font_label, line, C_TEAL), (x + 10, y + 28 + 20 * (len(rows) + i)))
+
+@functools.lru_cache(maxsize=8)
+def metrics_panel(rows):
+    panel = pygame.Surface((440, 36 + 20 * rows), pygame.SRCALPHA)
+    panel.fill((0, 0, 0, 200))
+    return panel
+
+# ==========================================
+# SESSION RECORDING & REPLAY
+# ==========================================
+# A session log is LOG_MAGIC followed by append-only records:
+#
+#   t_ns int64 | kind uint8 | length uint32 | payload[length]
+#
+# REC_SERIAL holds the bytes exactly as read from the port, stamped with
+# their arrival time. REC_PING is a clock-sync ping, stamped when sent.
+# REC_FRAME is written once per frame, stamped when the frame's input was
+# polled, and holds the present time, the SPACE/R input and how many
+# serial events the frame consumed. REC_SEED pins the game's RNG. That is
+# enough to push a session back through Station.parse() and Game unchanged.
+LOG_MAGIC = b"CRLOG\x00\x00\x01"
+LOG_RECORD = struct.Struct("<qBI")
+FRAME_RECORD = struct.Struct("<qBH")
+FRAME_RECORD_V1 = struct.Struct("<qB")  # Before the event count was logged
+SEED_RECORD = struct.Struct("<Q")
+REC_SERIAL = 0
+REC_FRAME = 1
+REC_SEED = 2
+REC_PING = 3
+INPUT_CONFIRM = 1
+INPUT_RESTART = 2
+
+replay_inputs = deque()  # Input masks due now, fed by replay_serial()
+
+class SessionRecorder:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "ab")
+        if self.file.tell() == 0:
+            self.file.write(LOG_MAGIC)
+        self.lock = threading.Lock()
+
+    def write(self, t_ns, kind, payload):
+        # Called from both the I/O core and the main loop
+        with self.lock:
+            self.file.write(LOG_RECORD.pack(t_ns, kind, len(payload)))
+            self.file.write(payload)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+def open_session_recorder(tag=None):
+    # tag tells apart logs opened in the same second (one per station)
+    os.makedirs(SESSION_LOG_DIR, exist_ok=True)
+    name = time.strftime("session-%Y%m%d-%H%M%S")
+    if tag: name += "-" + re.sub(r"[^A-Za-z0-9]+", "_", tag).strip("_")
+    return SessionRecorder(os.path.join(SESSION_LOG_DIR, name + ".crlog"))
+
+def open_results_store():
+    try:
+        return ResultsStore(RESULTS_DB_PATH)
+    except sqlite3.Error as e:
+        print(f"WARNING: results store unavailable, laps won't be kept: {e}")
+        return None
+
+def read_session_log(path):
+    # Returns [(t_ns, kind, payload)] sorted by time. The I/O core and the
+    # main loop append independently, so file order is only roughly
+    # chronological. A truncated final record (crash mid-write) is dropped.
+    records = []
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size < len(LOG_MAGIC): return records
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if mm[:len(LOG_MAGIC)] != LOG_MAGIC:
+                raise ValueError(f"{path} is not a session log")
+            pos, size = len(LOG_MAGIC), len(mm)
+            while pos + LOG_RECORD.size <= size:
+                t_ns, kind, length = LOG_RECORD.unpack_from(mm, pos)
+                start = pos + LOG_RECORD.size
+                if start + length > size: break
+                records.append((t_ns, kind, mm[start:start + length]))
+                pos = start + length
+    records.sort(key=lambda r: r[0])
+    return records
+
+def unpack_frame_record(payload):
+    # Returns (presented_ns, input mask, events consumed or None)
+    if len(payload) == FRAME_RECORD_V1.size:
+        return FRAME_RECORD_V1.unpack(payload) + (None,)
+    return FRAME_RECORD.unpack(payload)
+
+def log_seed(records):
+    for t_ns, kind, payload in records:
+        if kind == REC_SEED: return SEED_RECORD.unpack(payload)[0]
+    return None
+
+def replay_session(path):
+    # Reruns a recorded session through the parser and state machine as
+    # fast as possible, headless. Returns the Game as it ended.
+    records = read_session_log(path)
+    now = [records[0][0] if records else 0]
+    seed = log_seed(records)
+    game = Game(clock=lambda: now[0], rng=random.Random(seed))
+    st = Station(path, persist=False)
+    pending = b""
+    backlog = []  # Parsed, but not consumed by the frame that was live then
+    for t_ns, kind, payload in records:
+        now[0] = t_ns
+        if kind == REC_SERIAL:
+            pending += payload
+            pending = pending[st.parse(pending, t_ns):]
+        elif kind == REC_PING:
+            st.clock_sync.on_ping(PING_RECORD.unpack(payload)[0], t_ns)
+        elif kind == REC_FRAME:
+            presented_ns, mask, consumed = unpack_frame_record(payload)
+            backlog += st.get_events()
+            if consumed is None: consumed = len(backlog)
+            events, backlog = backlog[:consumed], backlog[consumed:]
+            game.update(events, FrameInput(bool(mask & INPUT_CONFIRM), bool(mask & INPUT_RESTART)))
+            game.on_present(presented_ns)
+    return game
+
+def replay_serial(st, records):
+    # Stands in for the I/O core when replaying a log in a window: serial
+    # chunks and recorded inputs are released at their original pace. Only
+    # 1x: the game's timers and the clock fit run on the real clock.
+    t0, start = records[0][0], time.perf_counter_ns()
+    for t_ns, kind, payload in records:
+        due = start + (t_ns - t0)
+        if reader_stop.wait(max(0, due - time.perf_counter_ns()) / 1e9): break
+        if kind == REC_SERIAL:
+            st.feed(payload, time.perf_counter_ns())
+        elif kind == REC_PING:
+            st.clock_sync.on_ping(PING_RECORD.unpack(payload)[0], time.perf_counter_ns())
+        elif kind == REC_FRAME:
+            mask = unpack_frame_record(payload)[1]
+            if mask: replay_inputs.append(mask)
+
+# ==========================================
+# MAIN LOOP
+# ==========================================
+# One game per station, side by side in one window. Clicking a screen
+# confirms on that station; SPACE confirms and R restarts on all of them.
+def main(ports=(SERIAL_PORT,), replay_path=None):
+    global screen, WIDTH, HEIGHT
+    # The window comes up first; ports open and detection runs in the
+    # background while the first frames are shown
+    init_display(1 if replay_path else len(ports))
+    if replay_path:
+        records = read_session_log(replay_path)
+        stations[:] = [Station(replay_path, persist=False)]
+        seeds = [log_seed(records) or random.randrange(2**63)]
+        if records: start_serial_reader(stations, replay=records)
+    else:
+        stations[:] = [Station(port) for port in ports]
+        seeds = [random.randrange(2**63) for _ in stations]
+        for st, seed in zip(stations, seeds):
+            if AUTO_CALIBRATE and st.load_calibration():
+                st.apply_calibration()
+            if RECORD_SESSIONS:
+                st.recorder = open_session_recorder(st.port if len(stations) > 1 else None)
+                st.recorder.write(time.perf_counter_ns(), REC_SEED, SEED_RECORD.pack(seed))
+        start_serial_reader(stations)
+        start_calibration_writer()
+    results = open_results_store() if RESULTS_DB_PATH and not replay_path else None
+    display = screen
+    tiles = station_tiles(len(stations))
+
+    # The games see one time per frame, the time input was polled, so
+    # a replay driven by the REC_FRAME stamps makes the same decisions
+    frame_ns = time.perf_counter_ns()
+    games = [Game(clock=lambda: frame_ns, rng=random.Random(seed), results=results, station=st.port)
+             for st, seed in zip(stations, seeds)]
+    scheduler = FrameScheduler(TARGET_FPS, VSYNC, DISPLAY_REFRESH_HZ, LOW_LATENCY)
+    presented_states = [None] * len(games)
+    show_metrics = False
+    roll_metrics_window(time.perf_counter_ns())
+
+    running = True
+    while running:
+        scheduler.begin_frame()
+        confirm = [False] * len(games)
+        restart = False
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT: running = False
+            elif event.type == pygame.MOUSEBUTTONDOWN:
+                for i, tile in enumerate(tiles):
+                    if tile.get_rect(topleft=tile.get_abs_offset()).collidepoint(event.pos): confirm[i] = True
+            elif event.type == pygame.KEYDOWN:
+                if event.key == pygame.K_SPACE: confirm = [True] * len(games)
+                elif event.key == pygame.K_r: restart = True
+                elif event.key == pygame.K_F3:
+                    show_metrics = not show_metrics
+                    presented_states = [None] * len(games)  # Full present clears the old overlay
+                elif event.key in (pygame.K_MINUS, pygame.K_KP_MINUS): zoom_telemetry(+1)
+                elif event.key in (pygame.K_EQUALS, pygame.K_PLUS, pygame.K_KP_PLUS): zoom_telemetry(-1)
+            elif event.type == pygame.VIDEORESIZE and len(games) == 1:
+                # A grid is SCALED and keeps its size; one screen reflows
+                screen = display = pygame.display.get_surface()
+                WIDTH, HEIGHT = screen.get_size()
+                tiles = station_tiles(1)
+                invalidate_render_cache()
+                games[0].summary = None  # Graph layout follows the window size
+                presented_states = [None]
+        while replay_inputs:
+            mask = replay_inputs.popleft()
+            confirm[0] |= bool(mask & INPUT_CONFIRM); restart |= bool(mask & INPUT_RESTART)
+
+        # Stamped after the queues are drained, so every event this frame
+        # takes arrived before frame_ns, in the logs as well
+        serial_events = [st.get_events() for st in stations]
+        frame_ns = time.perf_counter_ns()
+        for game, st in zip(games, stations):
+            game.station = st.port  # Settled once an 'auto' port is found
+        for game, events, confirmed in zip(games, serial_events, confirm):
+            update_game(game, events, FrameInput(confirmed, restart))
 
-        draw_centered("[R] RESTART SESSION", font_mono, (150,150,150), 320)
+        for tile, st, game in zip(tiles, stations, games):
+            screen = tile
+            draw_frame(game, st)
+        screen = display
+        if show_metrics: draw_metrics_overlay()
 
-        if keys[pygame.K_r]:
-            current_state = STATE_LANDING
-            flush_serial()
+        # Full present on the first frame of a state, dirty regions after that
+        rects = None if show_metrics else []
+        for tile, game, presented_state in zip(tiles, games, presented_states):
+            tile_rects = dirty_rects(game.state) if game.state == presented_state else None
+            if rects is None or tile_rects is None:
+                rects = None; break
+            rects += [r.move(tile.get_abs_offset()) for r in tile_rects]
+        presented_ns = scheduler.present(rects)
+        presented_states = [game.state for game in games]
+        for st, game, events, confirmed in zip(stations, games, serial_events, confirm):
+            game.on_present(presented_ns)
+            if st.recorder:
+                mask = (INPUT_CONFIRM if confirmed else 0) | (INPUT_RESTART if restart else 0)
+                st.recorder.write(frame_ns, REC_FRAME, FRAME_RECORD.pack(presented_ns, mask, len(events)))
+        for st in stations: st.save_calibration()
+        if presented_ns - metrics_window_start >= METRICS_WINDOW * 1e9:
+            roll_metrics_window(presented_ns)
 
-    pygame.display.flip()
+    stop_serial_reader()
+    for st in stations:
+        st.save_calibration(now=True)
+        if st.recorder: st.recorder.close()
+    stop_calibration_writer()
+    if results: results.close()
+    pygame.quit()
 
-pygame.quit()
-if ser: ser.close()
\ No newline at end of file
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ColorTap: DSP-Enabled Reaction Game")
+    parser.add_argument("--port", nargs="+", default=[SERIAL_PORT],
+                        help=f"Arduino serial port, or several for one station each (default {SERIAL_PORT})")
+    parser.add_argument("--replay", metavar="LOG", help="replay a recorded session log instead of the Arduino")
+    parser.add_argument("--speed", default="1", choices=["1", "max"],
+                        help="replay at 1x in the window, or 'max' to rerun headless")
+    args = parser.parse_args()
+    if args.replay and args.speed == "max":
+        game = replay_session(args.replay)
+        for i, entry in enumerate(game.history):
+            print(f"LAP {i+1}: {int(entry['raw'])} ms +{int(entry['penalty'])} {entry['status']}")
+    else:
+        main(args.port, args.replay)
@@ -0,0 +1,285 @@
+# ==========================================
+# HOST-SIDE DSP
+# ==========================================
+# The piezo filters, run on the host over blocks of raw samples instead of
+# in the firmware, so they can be retuned without reflashing and tried
+# against recorded sessions. A DSPChain is three pluggable parts:
+#
+#   filters   raw -> "filtered" trace        (e.g. high-pass, low-pass)
+#   envelope  filtered -> "envelope" trace   (e.g. rectifier, smoothing)
+#   detector  envelope -> tap sample indices (hysteresis threshold)
+#
+# NoiseFloorCalibrator watches the envelope and suggests the detector's
+# thresholds from the sensor's own noise floor.
+#
+# Every stage keeps its state between blocks, so feeding a stream in
+# blocks of any size gives the same output as feeding it in one go.
+# Linear stages use scipy.signal.lfilter when SciPy is installed and an
+# exact NumPy block formulation otherwise.
+#
+#   python dsp.py sessions/session-....crlog --on 90 --off 60 --highpass 5
+import math
+
+import numpy as np
+
+# Looked up on first use: importing scipy.signal takes longer than starting
+# the game window
+lfilter = False  # False until looked up, None without SciPy
+
+def get_lfilter():
+    global lfilter
+    if lfilter is False:
+        try:
+            from scipy.signal import lfilter
+        except ImportError:
+            lfilter = None
+    return lfilter
+
+NO_TAPS = np.zeros(0, dtype=np.intp)
+
+# --- LINEAR STAGES ---
+class IIRFilter:
+    # Direct-form II transposed IIR, coefficients as in lfilter(b, a)
+    MAX_BLOCK = 256  # Longer inputs are split; the fallback's matrices are n x n
+
+    def __init__(self, b, a):
+        b = np.asarray(b, dtype=np.float64)
+        a = np.asarray(a, dtype=np.float64)
+        order = max(len(a), len(b))
+        self.b = np.pad(b, (0, order - len(b))) / a[0]
+        self.a = np.pad(a, (0, order - len(a))) / a[0]
+        self.zi = np.zeros(order - 1)
+        self.blocks = {}  # Block length -> matrices, for the NumPy path
+
+    def reset(self):
+        self.zi[:] = 0
+
+    def process(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        if not len(self.zi): return self.b[0] * x
+        if get_lfilter() is not None:
+            y, self.zi = lfilter(self.b, self.a, x, zi=self.zi)
+            return y
+        if len(x) <= self.MAX_BLOCK:
+            return self._process_block(x)
+        return np.concatenate([self._process_block(x[i:i + self.MAX_BLOCK])
+                               for i in range(0, len(x), self.MAX_BLOCK)])
+
+    def _process_block(self, x):
+        # The filter is linear, so over a block of n samples it is four
+        # matrices: output and final state, from the input and from the
+        # initial state. They are worked out once per block length.
+        m = self.blocks.get(len(x))
+        if m is None:
+            m = self.blocks[len(x)] = self._block_matrices(len(x))
+        from_x, from_z, state_x, state_z = m
+        y = from_x @ x + from_z @ self.zi
+        self.zi = state_x @ x + state_z @ self.zi
+        return y
+
+    def _block_matrices(self, n):
+        order = len(self.zi)
+        from_x, state_x = np.zeros((n, n)), np.zeros((order, n))
+        from_z, state_z = np.zeros((n, order)), np.zeros((order, order))
+        for k in range(n):
+            from_x[:, k], state_x[:, k] = self._step(np.eye(n)[k], np.zeros(order))
+        for j in range(order):
+            from_z[:, j], state_z[:, j] = self._step(np.zeros(n), np.eye(order)[j])
+        return from_x, from_z, state_x, state_z
+
+    def _step(self, x, z):
+        # Reference sample-by-sample filter
+        b, a = self.b, self.a
+        z = z.copy()
+        y = np.empty(len(x))
+        for i, xi in enumerate(x):
+            y[i] = b[0] * xi + z[0]
+            z[:-1] = b[1:-1] * xi - a[1:-1] * y[i] + z[1:]
+            z[-1] = b[-1] * xi - a[-1] * y[i]
+        return y, z
+
+class OnePoleLowPass(IIRFilter):
+    # y = alpha * y + (1 - alpha) * x, the firmware's smoothing filter
+    def __init__(self, alpha):
+        self.alpha = alpha
+        super().__init__([1 - alpha], [1, -alpha])
+
+class BiquadHighPass(IIRFilter):
+    # RBJ cookbook high-pass; strips DC offset and slow drift off the piezo
+    def __init__(self, cutoff_hz, sample_rate, q=math.sqrt(0.5)):
+        self.cutoff_hz = cutoff_hz
+        w0 = 2 * math.pi * cutoff_hz / sample_rate
+        cos_w0, alpha = math.cos(w0), math.sin(w0) / (2 * q)
+        super().__init__([(1 + cos_w0) / 2, -(1 + cos_w0), (1 + cos_w0) / 2],
+                         [1 + alpha, -2 * cos_w0, 1 - alpha])
+
+# --- NON-LINEAR STAGES ---
+class Rectifier:
+    def reset(self): pass
+
+    def process(self, x):
+        return np.abs(x)
+
+class HysteresisDetector:
+    # A tap is the envelope rising above `on`; the next one can't fire until
+    # it has fallen to `off` or below. Returns the sample indices of taps.
+    def __init__(self, on, off=None):
+        self.on = on
+        self.off = on if off is None else off
+        self.high = False
+
+    def reset(self):
+        self.high = False
+
+    def process(self, env):
+        n = len(env)
+        if not n: return NO_TAPS
+        # Fast paths: the whole block on one side of the band (most blocks)
+        if env.max() <= self.off:
+            self.high = False
+            return NO_TAPS
+        if env.min() > self.on:
+            fired = NO_TAPS if self.high else np.zeros(1, dtype=np.intp)
+            self.high = True
+            return fired
+        # +1 where the level says "high", -1 where it says "low", 0 in the
+        # dead band, which keeps whatever came before
+        mark = np.zeros(n, dtype=np.int8)
+        mark[env > self.on] = 1
+        mark[env <= self.off] = -1
+        last = np.where(mark != 0, np.arange(n), -1)
+        np.maximum.accumulate(last, out=last)
+        high = np.where(last >= 0, mark[last] > 0, self.high)
+        before = np.empty(n, dtype=bool)
+        before[0] = self.high
+        before[1:] = high[:-1]
+        self.high = bool(high[-1])
+        return np.flatnonzero(high & ~before)
+
+# --- CHAIN ---
+class DSPChain:
+    def __init__(self, filters=(), envelope=(), detector=None):
+        self.filters = list(filters)
+        self.envelope = list(envelope)
+        self.detector = detector
+
+    def reset(self):
+        for stage in self.filters + self.envelope: stage.reset()
+        if self.detector: self.detector.reset()
+
+    def process(self, raw):
+        # Returns (filtered, envelope, tap indices into this block)
+        filtered = np.asarray(raw, dtype=np.float64)
+        for stage in self.filters: filtered = stage.process(filtered)
+        env = filtered
+        for stage in self.envelope: env = stage.process(env)
+        taps = self.detector.process(env) if self.detector else NO_TAPS
+        return filtered, env, taps
+
+def firmware_chain(alpha=0.90, decay=0.8, on=80, off=60, highpass_hz=None, sample_rate=100):
+    # The sketch's filters (low-pass, then |x| smoothed into an envelope),
+    # with hysteresis added to the threshold and an optional high-pass first
+    filters = [OnePoleLowPass(alpha)]
+    if highpass_hz: filters.insert(0, BiquadHighPass(highpass_hz, sample_rate))
+    return DSPChain(filters, [Rectifier(), OnePoleLowPass(decay)], HysteresisDetector(on, off))
+
+# --- CALIBRATION ---
+class NoiseFloorCalibrator:
+    # Rolling median and MAD of the envelope over the last `window` samples.
+    # Both shrug off the occasional tap, so they track the resting noise of
+    # the mounting. The trigger sits on_sigmas robust standard deviations
+    # above the median (never below min_on); taps re-arm off_sigmas /
+    # on_sigmas of the way up from the median to the trigger.
+    MAD_TO_SIGMA = 1.4826  # For Gaussian noise
+
+    def __init__(self, window=1000, on_sigmas=8.0, off_sigmas=4.0, min_on=30.0,
+                 min_samples=200, every=50, tolerance=0.05):
+        self.ring = np.zeros(window)
+        self.head = self.count = 0
+        self.on_sigmas, self.off_sigmas, self.min_on = on_sigmas, off_sigmas, min_on
+        self.min_samples = min_samples  # Before the first estimate
+        self.every = every              # Samples between estimates
+        self.tolerance = tolerance      # Relative change worth reporting
+        self.since = 0
+        self.floor = self.spread = 0.0
+        self.on = self.off = None       # Current suggestion
+
+    def update(self, env):
+        # Returns True when the suggested thresholds have moved
+        env = np.asarray(env, dtype=np.float64)[-len(self.ring):]
+        n, size = len(env), len(self.ring)
+        first = min(n, size - self.head)
+        self.ring[self.head:self.head + first] = env[:first]
+        self.ring[:n - first] = env[first:]
+        self.head = (self.head + n) % size
+        self.count = min(self.count + n, size)
+        self.since += n
+        if self.count < self.min_samples or self.since < self.every: return False
+        self.since = 0
+
+        data = self.ring[:self.count]
+        self.floor = float(np.median(data))
+        self.spread = float(np.median(np.abs(data - self.floor))) * self.MAD_TO_SIGMA
+        on = max(self.min_on, self.floor + self.on_sigmas * self.spread)
+        # Re-arm the same fraction of the way down to the floor, even when
+        # on is held up by min_on over a near-silent (MAD 0) sensor
+        off = self.floor + (on - self.floor) * min(self.off_sigmas / self.on_sigmas, 0.75)
+        if self.on is not None and abs(on - self.on) <= self.tolerance * self.on: return False
+        self.on, self.off = on, off
+        return True
+
+    def state(self):
+        return {"on": self.on, "off": self.off, "floor": self.floor, "spread": self.spread}
+
+    def load(self, state):
+        # A saved suggestion stands until there is enough data to replace it
+        self.on, self.off = state["on"], state["off"]
+        self.floor, self.spread = state.get("floor", 0.0), state.get("spread", 0.0)
+
+# --- OFFLINE ---
+def session_samples(path, sample_rate=100):
+    # Raw samples, their estimated times and the firmware's TAP times from
+    # a session log, by running it back through the game's parser
+    import color_game as cg
+    blocks, times, taps = [], [], []
+    period = 1e9 / sample_rate
+
+    class Collector(cg.Station):
+        def handle_samples(self, samples, arrival_ns):
+            # A block arrives at once; its last sample is the newest
+            blocks.append(np.array(samples[:, 0]))
+            times.append(arrival_ns - period * np.arange(len(samples) - 1, -1, -1))
+
+        def handle_command(self, cmd, arrival_ns, device_us=None):
+            if cmd == "TAP": taps.append(arrival_ns)
+
+    station = Collector(path, persist=False)
+    pending = b""
+    for t_ns, kind, payload in cg.read_session_log(path):
+        if kind == cg.REC_SERIAL:
+            pending += payload
+            pending = pending[station.parse(pending, t_ns):]
+    if not blocks: return NO_TAPS, np.zeros(0), np.asarray(taps)
+    return np.concatenate(blocks), np.concatenate(times), np.asarray(taps)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Run a DSP chain over a recorded session")
+    parser.add_argument("log", help="session log (.crlog)")
+    parser.add_argument("--alpha", type=float, default=0.90, help="low-pass coefficient")
+    parser.add_argument("--decay", type=float, default=0.8, help="envelope coefficient")
+    parser.add_argument("--on", type=float, default=80, help="tap threshold")
+    parser.add_argument("--off", type=float, default=60, help="re-arm level")
+    parser.add_argument("--highpass", type=float, default=None, help="high-pass cutoff, Hz")
+    parser.add_argument("--rate", type=int, default=100, help="sample rate, Hz")
+    args = parser.parse_args()
+
+    raw, times, firmware_taps = session_samples(args.log, args.rate)
+    chain = firmware_chain(args.alpha, args.decay, args.on, args.off, args.highpass, args.rate)
+    _, env, taps = chain.process(raw)
+    tap_times = times[taps]
+    print(f"{len(raw)} samples, envelope peak {env.max() if len(env) else 0:.0f}")
+    print(f"firmware taps: {len(firmware_taps)}   chain taps: {len(taps)}")
+    for t in tap_times:
+        nearest = np.abs(firmware_taps - t).min() / 1e6 if len(firmware_taps) else float("nan")
+        print(f"  tap at {(t - times[0]) / 1e9:8.3f} s   nearest firmware TAP {nearest:7.1f} ms away")
@@ -0,0 +1,208 @@
+# ==========================================
+# RESULTS STORE
+# ==========================================
+# Every lap and session, kept in SQLite so results outlive the game. The
+# frame loop never touches the disk: writes are queued and a background
+# thread commits them in batches. The database runs in WAL mode, so the
+# game's own queries (and a second process, e.g. a leaderboard screen)
+# read while the writer commits.
+#
+#   sessions  one row per session: start/end wall time, and the lap count,
+#             total and average once it is complete
+#   laps      one row per lap: raw reaction, penalty, status, target color,
+#             stimulus onset and press on the host clock, wall time
+#
+# Indexed for the leaderboard (sessions by average) and for per-color
+# percentiles (correct laps by target, then reaction time). Session ids
+# are assigned by SQLite when the writer inserts the row, so several
+# processes (one per cabinet) can share a database.
+#
+#   python results.py                  # leaderboard and per-color percentiles
+#   python results.py --db other.db --top 20
+import math
+import queue
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    station TEXT,
+    started_at REAL NOT NULL,  -- Unix time
+    ended_at REAL,             -- NULL until the last lap is in
+    laps INTEGER,
+    total_ms REAL,
+    avg_ms REAL
+);
+CREATE TABLE IF NOT EXISTS laps (
+    session_id INTEGER NOT NULL REFERENCES sessions(id),
+    lap INTEGER NOT NULL,
+    raw_ms REAL NOT NULL,
+    penalty_ms REAL NOT NULL,
+    status TEXT NOT NULL,
+    target TEXT,               -- NULL if no color was picked yet (jump start)
+    onset_ns INTEGER,          -- perf_counter_ns() the card was first presented
+    press_ns INTEGER,          -- perf_counter_ns() of the press
+    recorded_at REAL NOT NULL, -- Unix time
+    PRIMARY KEY (session_id, lap)
+);
+CREATE INDEX IF NOT EXISTS sessions_by_avg ON sessions(avg_ms) WHERE avg_ms IS NOT NULL;
+CREATE INDEX IF NOT EXISTS laps_by_color ON laps(target, status, raw_ms);
+"""
+
+# The session's id is bound as the first parameter of the others
+INSERT_SESSION = "INSERT INTO sessions (station, started_at) VALUES (?, ?)"
+INSERT_LAP = "INSERT OR REPLACE INTO laps VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+END_SESSION = "UPDATE sessions SET ended_at = ?2, laps = ?3, total_ms = ?4, avg_ms = ?5 WHERE id = ?1"
+
+class Session:
+    # Handed out by begin_session() before the row exists; the writer sets
+    # id when it inserts it (None until then, or if the insert failed)
+    __slots__ = ("id",)
+
+    def __init__(self):
+        self.id = None
+
+class ResultsStore:
+    BATCH_DELAY = 0.5   # Seconds the writer waits for more rows before committing
+    MAX_BATCH = 256
+
+    def __init__(self, path):
+        self.path = path
+        # The main thread's connection: schema, ids and queries
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+        self.ops = queue.SimpleQueue()  # (sql, Session, params), threading.Event to flush, None to stop
+        self.rows_written = 0
+        self.write_errors = 0
+        self.thread = threading.Thread(target=self.run, name="results-writer", daemon=True)
+        self.thread.start()
+
+    # --- WRITES (any thread, never block) ---
+    def begin_session(self, station=None, started_at=None):
+        # Returns a Session to pass to record_lap() and end_session(); the
+        # caller doesn't wait for the insert
+        session = Session()
+        self.ops.put((INSERT_SESSION, session, (station, started_at or time.time())))
+        return session
+
+    def record_lap(self, session, lap, raw_ms, penalty_ms, status, target=None, onset_ns=None, press_ns=None):
+        self.ops.put((INSERT_LAP, session, (lap, raw_ms, penalty_ms, status, target,
+                                            onset_ns, press_ns, time.time())))
+
+    def end_session(self, session, laps, total_ms):
+        avg_ms = total_ms / laps if laps else None
+        self.ops.put((END_SESSION, session, (time.time(), laps, total_ms, avg_ms)))
+
+    def flush(self, timeout=None):
+        # Waits until everything queued so far is committed
+        done = threading.Event()
+        self.ops.put(done)
+        return done.wait(timeout)
+
+    def close(self):
+        self.ops.put(None)
+        self.thread.join()
+        self.db.close()
+
+    # --- WRITER THREAD ---
+    def run(self):
+        db = sqlite3.connect(self.path, isolation_level=None)  # Transactions are managed in write()
+        db.execute("PRAGMA synchronous=NORMAL")  # Durable across app crashes; WAL keeps it consistent
+        stopping = False
+        while not stopping:
+            batch, flushes = [], []
+            op = self.ops.get()
+            deadline = time.monotonic() + self.BATCH_DELAY
+            while True:
+                if op is None: stopping = True; break
+                if isinstance(op, threading.Event): flushes.append(op); break
+                batch.append(op)
+                if len(batch) >= self.MAX_BATCH: break
+                try:
+                    op = self.ops.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+            if batch: self.write(db, batch)
+            for done in flushes: done.set()
+        db.close()
+
+    def write(self, db, batch):
+        # One transaction per batch, one savepoint per row, so a bad row
+        # is dropped on its own
+        written, errors = 0, self.write_errors
+        try:
+            db.execute("BEGIN")
+            for sql, session, params in batch:
+                db.execute("SAVEPOINT row")
+                try:
+                    if sql == INSERT_SESSION:
+                        session.id = db.execute(sql, params).lastrowid
+                    elif session.id is None:
+                        raise sqlite3.IntegrityError("its session was never stored")
+                    else:
+                        db.execute(sql, (session.id,) + params)
+                    written += 1
+                except sqlite3.Error as e:
+                    db.execute("ROLLBACK TO row")
+                    self.write_errors += 1
+                    print(f"WARNING: results row dropped: {e}")
+                db.execute("RELEASE row")
+            db.execute("COMMIT")
+            self.rows_written += written
+        except sqlite3.Error as e:
+            if db.in_transaction: db.execute("ROLLBACK")
+            for sql, session, params in batch:
+                if sql == INSERT_SESSION: session.id = None
+            self.write_errors = errors + len(batch)
+            print(f"WARNING: results write failed: {e}")
+
+    # --- QUERIES (main thread) ---
+    def leaderboard(self, limit=10):
+        # Completed sessions, best average first: (id, station, started_at, laps, avg_ms)
+        return self.db.execute(
+            "SELECT id, station, started_at, laps, avg_ms FROM sessions"
+            " WHERE avg_ms IS NOT NULL ORDER BY avg_ms LIMIT ?", (limit,)).fetchall()
+
+    def rank(self, avg_ms, exclude=None):
+        # Where a session average would place: (rank, out of), counting
+        # completed sessions other than `exclude` (a Session)
+        before, others = self.db.execute(
+            "SELECT COALESCE(SUM(avg_ms < ?), 0), COUNT(*) FROM sessions"
+            " WHERE avg_ms IS NOT NULL AND id IS NOT ?", (avg_ms, exclude and exclude.id)).fetchone()
+        return before + 1, others + 1
+
+    def color_percentiles(self, target, percentiles=(50, 90, 99)):
+        # Nearest-rank percentiles of correct reactions to `target`, in ms,
+        # read in order off the laps_by_color index (no sort)
+        where = "FROM laps WHERE target = ? AND status = 'CORRECT'"
+        n = self.db.execute(f"SELECT COUNT(*) {where}", (target,)).fetchone()[0]
+        if not n: return {p: None for p in percentiles}
+        return {p: self.db.execute(f"SELECT raw_ms {where} ORDER BY raw_ms LIMIT 1 OFFSET ?",
+                                   (target, max(math.ceil(p / 100 * n) - 1, 0))).fetchone()[0]
+                for p in percentiles}
+
+    def colors(self):
+        return [row[0] for row in self.db.execute(
+            "SELECT DISTINCT target FROM laps WHERE target IS NOT NULL ORDER BY target")]
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Show the leaderboard and reaction percentiles")
+    parser.add_argument("--db", default="results.db", help="results database")
+    parser.add_argument("--top", type=int, default=10, help="leaderboard entries")
+    args = parser.parse_args()
+
+    store = ResultsStore(args.db)
+    print("LEADERBOARD")
+    for i, (session_id, station, started_at, laps, avg_ms) in enumerate(store.leaderboard(args.top)):
+        when = time.strftime("%Y-%m-%d %H:%M", time.localtime(started_at))
+        print(f"  {i + 1:>3}. {avg_ms:8.1f} ms  {laps} laps  {when}  {station or ''}  (session {session_id})")
+    print("CORRECT REACTIONS BY COLOR")
+    for color in store.colors():
+        pcts = store.color_percentiles(color)
+        print(f"  {color:<8}" + "  ".join(f"p{p} {v:7.1f} ms" if v is not None else f"p{p}     n/a"
+                                          for p, v in pcts.items()))
+    store.close()
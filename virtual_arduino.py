@@ -0,0 +1,241 @@
+# ==========================================
+# VIRTUAL ARDUINO
+# ==========================================
+# Software stand-in for ChromaReflex_Arduino.ino. It opens a pseudo
+# terminal, so it needs Linux or macOS, and speaks the same protocol as
+# the firmware: binary frames or ASCII lines. It synthesises piezo hits,
+# runs them through the firmware's low-pass and envelope filters and
+# threshold, and sends buttons on demand. Every event it writes is kept
+# with the perf_counter_ns() of the write in `events`, so callers have
+# ground truth to score against.
+#
+# Its micros() runs off perf_counter, optionally off by clock_ppm, and it
+# answers the host's clock-sync pings. usb_jitter (seconds) delays each
+# write by a random amount after it is stamped, like USB buffering does.
+#
+#   python virtual_arduino.py --auto      # then: python color_game.py --port <pty>
+import os
+import tty
+import select
+import binascii
+import math
+import time
+import random
+import struct
+import argparse
+import threading
+
+import color_game as cg
+
+EVENT_IDS = {name: code for code, name in cg.EVENT_CODES.items()}
+
+class VirtualArduino:
+    def __init__(self, sample_rate=100, samples_per_frame=8, binary=True,
+                 threshold=80, noise=3.0, seed=None, clock_ppm=0.0, usb_jitter=0.0, timestamps=True):
+        self.sample_rate = sample_rate
+        self.samples_per_frame = samples_per_frame
+        self.binary = binary
+        self.threshold = threshold
+        self.release = threshold  # Re-arm level, set by the host's calibration
+        self.noise = noise
+        self.rng = random.Random(seed)
+        self.clock_ppm = clock_ppm
+        self.usb_jitter = usb_jitter
+        self.timestamps = timestamps  # False: events without micros(), like older firmware
+        self.boot_ns = time.perf_counter_ns()
+
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        # Like a USB CDC device with nobody listening: if the host stops
+        # reading, output is dropped (and counted) rather than blocking
+        os.set_blocking(self.master, False)
+        self.port = os.ttyname(self.slave)
+        self.write_lock = threading.Lock()
+        self.bytes_dropped = 0
+
+        # Ground truth: (kind, perf_counter_ns of the write)
+        self.events = []
+        self.samples_sent = 0
+
+        # Firmware filter state
+        self.alpha = 0.90
+        self.filtered = 0.0
+        self.envelope = 0.0
+        self.tap_detected = False
+
+        self.bursts = []  # (start sample index, amplitude)
+        self.sample_index = 0
+        self.batch = []
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.host_thread = None
+        self.pongs_sent = 0
+
+    # --- CLOCK ---
+    def micros(self, t_ns):
+        return int((t_ns - self.boot_ns) * (1 + self.clock_ppm * 1e-6) / 1000) & 0xFFFFFFFF
+
+    # --- WIRE ---
+    def write(self, data):
+        # Returns the time the bytes were handed to the wire
+        with self.write_lock:
+            t_ns = time.perf_counter_ns()
+            if self.usb_jitter: time.sleep(self.rng.uniform(0, self.usb_jitter))
+            try:
+                self.bytes_dropped += len(data) - os.write(self.master, data)
+            except BlockingIOError:
+                self.bytes_dropped += len(data)
+            return t_ns
+
+    def send_event(self, name):
+        t_ns = time.perf_counter_ns()
+        if not self.timestamps:
+            data = cg.encode_frame(cg.FRAME_EVENT, bytes((EVENT_IDS[name],))) if self.binary else f"{name}\r\n".encode()
+        elif self.binary:
+            data = cg.encode_frame(cg.FRAME_EVENT, bytes((EVENT_IDS[name],)) + cg.EVENT_TIME.pack(self.micros(t_ns)))
+        else:
+            data = f"{name} {self.micros(t_ns)}\r\n".encode()
+        self.write(data)
+        self.events.append((name, t_ns))
+        return t_ns
+
+    def send_pong(self, seq, t_ns):
+        if self.binary:
+            self.write(cg.encode_frame(cg.FRAME_PONG, cg.PONG_RECORD.pack(seq, self.micros(t_ns))))
+        else:
+            self.write(f"PONG {seq} {self.micros(t_ns)}\r\n".encode())
+        self.pongs_sent += 1
+
+    def send_samples(self, rows):
+        if self.binary:
+            payload = b"".join(struct.pack("<3h", *row) for row in rows)
+            self.write(cg.encode_frame(cg.FRAME_SAMPLES, payload))
+        else:
+            self.write(b"".join(b"RAW: %d | FILTER: %d | ENVELOPE: %d\r\n" % row for row in rows))
+        self.samples_sent += len(rows)
+
+    # --- STIMULUS ---
+    def tap(self, amplitude=600):
+        # Schedules a piezo hit; TAP goes out when the envelope crosses
+        # the threshold, exactly as the firmware would report it
+        self.bursts.append((self.sample_index, amplitude))
+
+    def press(self, color):
+        # color: "RED" (shown as YELLOW in game), "GREEN" or "BLUE"
+        return self.send_event(color)
+
+    def piezo(self, i):
+        raw = self.rng.gauss(0, self.noise)
+        for start, amp in self.bursts:
+            t = (i - start) / self.sample_rate
+            raw += amp * math.exp(-t / 0.12) * abs(math.sin(2 * math.pi * 40 * t))
+        self.bursts = [(st, a) for st, a in self.bursts if (i - st) / self.sample_rate < 1.0]
+        return int(min(max(raw, 0), 1023))
+
+    def step(self):
+        raw = self.piezo(self.sample_index)
+        self.sample_index += 1
+        self.filtered = self.alpha * self.filtered + (1 - self.alpha) * raw
+        self.envelope = 0.8 * self.envelope + 0.2 * abs(self.filtered)
+        self.batch.append((raw, int(self.filtered), int(self.envelope)))
+        if len(self.batch) >= self.samples_per_frame:
+            self.send_samples(self.batch)
+            self.batch = []
+
+        if self.envelope > self.threshold:
+            if not self.tap_detected:
+                self.tap_detected = True
+                self.send_event("TAP")
+        elif self.envelope <= self.release:
+            self.tap_detected = False
+
+    # --- HOST -> DEVICE ---
+    def listen(self):
+        # Answers pings as soon as they arrive, stamped on receipt
+        pending = b""
+        while not self.stop_event.is_set():
+            if not select.select([self.master], [], [], 0.05)[0]: continue
+            try:
+                pending += os.read(self.master, 4096)
+            except (BlockingIOError, OSError):
+                continue
+            t_ns = time.perf_counter_ns()
+            while True:
+                start = pending.find(bytes((cg.FRAME_SYNC,)))
+                if start < 0: pending = b""; break
+                pending = pending[start:]
+                if len(pending) < cg.FRAME_HEADER_SIZE: break
+                end = cg.FRAME_HEADER_SIZE + pending[3] + cg.FRAME_CRC_SIZE
+                if len(pending) < end: break
+                body, crc = pending[1:end - 2], pending[end - 2:end]
+                if pending[1] != cg.PROTOCOL_VERSION or struct.pack("<H", binascii.crc_hqx(body, 0)) != crc:
+                    pending = pending[1:]; continue
+                if pending[2] == cg.FRAME_PING and pending[3] == cg.PING_RECORD.size:
+                    self.send_pong(cg.PING_RECORD.unpack_from(pending, 4)[0], t_ns)
+                elif pending[2] == cg.FRAME_THRESHOLD and pending[3] == cg.THRESHOLD_RECORD.size:
+                    on, off = cg.THRESHOLD_RECORD.unpack_from(pending, 4)
+                    if off <= on: self.threshold, self.release = on, off
+                pending = pending[end:]
+
+    # --- STREAMING ---
+    def run(self):
+        period = 1e9 / self.sample_rate
+        next_ns = time.perf_counter_ns()
+        while not self.stop_event.is_set():
+            self.step()
+            next_ns += period
+            delay = (next_ns - time.perf_counter_ns()) / 1e9
+            if delay > 0: self.stop_event.wait(delay)
+
+    def start(self):
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, name="virtual-arduino", daemon=True)
+        self.thread.start()
+        self.host_thread = threading.Thread(target=self.listen, name="virtual-arduino-host", daemon=True)
+        self.host_thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread: self.thread.join()
+        if self.host_thread: self.host_thread.join()
+
+    def close(self):
+        self.stop()
+        os.close(self.master)
+        os.close(self.slave)
+
+def auto_play(device, interval=4.0):
+    # Soak-test driver: tap, then press a random button after a human-ish delay
+    while True:
+        time.sleep(interval)
+        device.tap()
+        time.sleep(3.0 + device.rng.uniform(0.2, 1.5) + device.rng.uniform(0.15, 0.4))
+        device.press(device.rng.choice(["RED", "GREEN", "BLUE"]))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Virtual ChromaReflex controller on a pty")
+    parser.add_argument("--rate", type=int, default=100, help="samples per second")
+    parser.add_argument("--batch", type=int, default=8, help="samples per binary frame")
+    parser.add_argument("--ascii", action="store_true", help="send ASCII lines instead of binary frames")
+    parser.add_argument("--auto", action="store_true", help="tap and press buttons on a loop")
+    parser.add_argument("--ppm", type=float, default=0.0, help="device clock error in ppm")
+    parser.add_argument("--jitter", type=float, default=0.0, help="max random USB delay per write, ms")
+    args = parser.parse_args()
+
+    device = VirtualArduino(args.rate, args.batch, binary=not args.ascii,
+                            clock_ppm=args.ppm, usb_jitter=args.jitter / 1000).start()
+    device.write(b"=== SYSTEM READY ===\r\n")
+    print(f"Virtual Arduino on {device.port}  (python color_game.py --port {device.port})")
+    try:
+        if args.auto:
+            auto_play(device)
+        else:
+            print("Keys + Enter: t = tap, r/g/b = button, q = quit")
+            for line in iter(input, "q"):
+                for key in line.strip().lower():
+                    if key == "t": device.tap()
+                    elif key in "rgb": device.press({"r": "RED", "g": "GREEN", "b": "BLUE"}[key])
+    except (KeyboardInterrupt, EOFError):
+        pass
+    device.close()